@@ -0,0 +1,42 @@
+"""user lookup indexes
+
+Revision ID: 07a350f5c23f
+Revises: c79673214a30
+Create Date: 2026-10-18 10:12:31.402214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from thorn.migration_utils import is_sqlite
+
+# revision identifiers, used by Alembic.
+revision = '07a350f5c23f'
+down_revision = 'c79673214a30'
+branch_labels = None
+depends_on = None
+
+# Not unique: a disabled user keeps login and email, and they can be used
+# again by a new registration.
+COLUMNS = ['login', 'email', 'api_token']
+
+
+def upgrade():
+    if not is_sqlite():
+        for column in COLUMNS:
+            op.create_index(op.f(f'ix_user_{column}'), 'user', [column],
+                            unique=False)
+    else:
+        with op.batch_alter_table('user') as batch_op:
+            for column in COLUMNS:
+                batch_op.create_index(op.f(f'ix_user_{column}'), [column],
+                                      unique=False)
+
+
+def downgrade():
+    if not is_sqlite():
+        for column in COLUMNS:
+            op.drop_index(op.f(f'ix_user_{column}'), table_name='user')
+    else:
+        with op.batch_alter_table('user') as batch_op:
+            for column in COLUMNS:
+                batch_op.drop_index(op.f(f'ix_user_{column}'))
@@ -0,0 +1,49 @@
+"""user effective permission
+
+Revision ID: 4c1e8d0a9b27
+Revises: dad5b1b431ce
+Create Date: 2026-10-18 14:21:05.114092
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import table, column
+
+# revision identifiers, used by Alembic.
+revision = '4c1e8d0a9b27'
+down_revision = 'dad5b1b431ce'
+branch_labels = None
+depends_on = None
+
+
+def _insert_effective_permissions():
+    user_role = table('user_role', column('user_id'), column('role_id'))
+    role = table('role', column('id'), column('enabled'))
+    role_permission = table('role_permission', column('role_id'),
+                            column('permission_id'))
+    effective = table('user_effective_permission', column('user_id'),
+                      column('permission_id'))
+    select = sa.select(
+        user_role.c.user_id, role_permission.c.permission_id).select_from(
+            user_role.join(role, sa.and_(
+                role.c.id == user_role.c.role_id,
+                role.c.enabled == sa.true())).join(
+                    role_permission,
+                    role_permission.c.role_id == role.c.id)).distinct()
+    op.execute(effective.insert().from_select(
+        ['user_id', 'permission_id'], select))
+
+
+def upgrade():
+    op.create_table('user_effective_permission',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('permission_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['permission_id'], ['permission.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'permission_id')
+    )
+    _insert_effective_permissions()
+
+
+def downgrade():
+    op.drop_table('user_effective_permission')
@@ -0,0 +1,34 @@
+"""role updated_at
+
+Revision ID: 9f2b7c4e1a36
+Revises: 4c1e8d0a9b27
+Create Date: 2026-10-18 20:02:41.530118
+
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import table, column
+from thorn.migration_utils import is_sqlite
+
+# revision identifiers, used by Alembic.
+revision = '9f2b7c4e1a36'
+down_revision = '4c1e8d0a9b27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('role', sa.Column('updated_at', sa.DateTime(),
+                                    nullable=True))
+    role = table('role', column('updated_at'))
+    op.execute(role.update().values(updated_at=datetime.datetime.utcnow()))
+
+
+def downgrade():
+    if is_sqlite():
+        with op.batch_alter_table('role') as batch_op:
+            batch_op.drop_column('updated_at')
+    else:
+        op.drop_column('role', 'updated_at')
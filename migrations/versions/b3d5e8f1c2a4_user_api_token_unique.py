@@ -0,0 +1,56 @@
+"""user api_token unique
+
+Revision ID: b3d5e8f1c2a4
+Revises: 9f2b7c4e1a36
+Create Date: 2026-10-18 21:14:07.220416
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import table, column
+from thorn.migration_utils import is_sqlite
+
+# revision identifiers, used by Alembic.
+revision = 'b3d5e8f1c2a4'
+down_revision = '9f2b7c4e1a36'
+branch_labels = None
+depends_on = None
+
+INDEX = 'ix_user_api_token'
+
+
+def _clear_duplicated_tokens():
+    """
+    A token shared by users authenticates as any of them, so duplicated
+    tokens are removed (users must generate new ones). Read before the
+    update, because MySQL does not allow a subquery on the updated table.
+    """
+    user = table('user', column('api_token'))
+    op.execute(user.update().where(user.c.api_token == '').values(
+        api_token=None))
+    duplicated = [token for (token, ) in op.get_bind().execute(
+        sa.select(user.c.api_token).where(
+            user.c.api_token.isnot(None)).group_by(
+                user.c.api_token).having(sa.func.count() > 1))]
+    if duplicated:
+        op.execute(user.update().where(
+            user.c.api_token.in_(duplicated)).values(api_token=None))
+
+
+def _replace_index(unique):
+    if not is_sqlite():
+        op.drop_index(INDEX, table_name='user')
+        op.create_index(INDEX, 'user', ['api_token'], unique=unique)
+    else:
+        with op.batch_alter_table('user') as batch_op:
+            batch_op.drop_index(INDEX)
+            batch_op.create_index(INDEX, ['api_token'], unique=unique)
+
+
+def upgrade():
+    _clear_duplicated_tokens()
+    _replace_index(True)
+
+
+def downgrade():
+    _replace_index(False)
@@ -0,0 +1,55 @@
+"""unread notifications
+
+Revision ID: dad5b1b431ce
+Revises: 07a350f5c23f
+Create Date: 2026-10-18 11:02:47.518732
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import table, column
+from thorn.migration_utils import is_sqlite
+
+# revision identifiers, used by Alembic.
+revision = 'dad5b1b431ce'
+down_revision = '07a350f5c23f'
+branch_labels = None
+depends_on = None
+
+INDEX_NAME = 'ix_notification_user_id_status_created'
+
+
+def _update_unread_notifications():
+    user = table('user', column('id'), column('unread_notifications'))
+    notification = table('notification', column('user_id'), column('status'))
+    total = sa.select(sa.func.count()).select_from(notification).where(
+        sa.and_(notification.c.user_id == user.c.id,
+                notification.c.status == 'UNREAD')).scalar_subquery()
+    op.execute(user.update().values(unread_notifications=total))
+
+
+def upgrade():
+    if not is_sqlite():
+        op.create_index(INDEX_NAME, 'notification',
+                        ['user_id', 'status', 'created'], unique=False)
+        op.add_column('user', sa.Column('unread_notifications', sa.Integer(),
+                                        server_default='0', nullable=False))
+    else:
+        with op.batch_alter_table('notification') as batch_op:
+            batch_op.create_index(INDEX_NAME, ['user_id', 'status', 'created'],
+                                  unique=False)
+        with op.batch_alter_table('user') as batch_op:
+            batch_op.add_column(sa.Column('unread_notifications', sa.Integer(),
+                                          server_default='0', nullable=False))
+    _update_unread_notifications()
+
+
+def downgrade():
+    if not is_sqlite():
+        op.drop_column('user', 'unread_notifications')
+        op.drop_index(INDEX_NAME, table_name='notification')
+    else:
+        with op.batch_alter_table('user') as batch_op:
+            batch_op.drop_column('unread_notifications')
+        with op.batch_alter_table('notification') as batch_op:
+            batch_op.drop_index(INDEX_NAME)
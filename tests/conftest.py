@@ -3,10 +3,32 @@ import os
 import pytest
 import datetime
 import flask_migrate
+from sqlalchemy import event
 from thorn.app import create_app
 from thorn.models import (AuthenticationType, User, Role, UserStatus, db)
 
 
+class QueryCounter:
+    """ Records the SQL statements executed in the engine """
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _callback(self, conn, cursor, statement, *args, **kwargs):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._callback)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, 'before_cursor_execute', self._callback)
+
+
 def get_users():
     u1 = User(
         id =2,
@@ -38,7 +60,7 @@ def get_users():
         last_name='Man',
         locale='pt',
         confirmed_at=datetime.datetime.now(),
-        api_token='SOME TOKEN',
+        api_token='OTHER TOKEN',
         roles=[])
 
     return [u1, u2]
@@ -62,3 +84,22 @@ def client(app):
             client.secret = app.config['THORN_CONFIG']['secret']
             db.session.commit()
         yield client
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """ Shared cache tier backed by fakeredis, returns the Redis server """
+    fakeredis = pytest.importorskip('fakeredis')
+    from thorn import cache
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(cache.redis.Redis, 'from_url', staticmethod(
+        lambda url, **kwargs: fakeredis.FakeRedis(server=server)))
+    for name, value in [('url', 'redis://fake'), ('_client', None),
+                        ('_down_until', 0), ('_listener', None),
+                        ('_handlers', dict(cache.redis_store._handlers))]:
+        monkeypatch.setattr(cache.redis_store, name, value)
+    monkeypatch.setattr(cache.decision_cache, 'shared', True)
+    monkeypatch.setattr(cache.decision_cache, 'enabled', True)
+    yield server
+    if cache.redis_store._listener is not None:
+        cache.redis_store._listener.stop()
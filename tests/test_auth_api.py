@@ -0,0 +1,528 @@
+from .conftest import *
+from flask import current_app
+import jwt
+from thorn.models import Configuration
+
+
+def test_validate_api_token_is_cached(client, app):
+    headers = {'X-Original-URI': '/api/v1/tahiti/x?api_token=SOME%20TOKEN',
+               'X-Original-Method': 'GET'}
+    rv = client.post('/auth/validate', headers=headers)
+    assert rv.status_code == 200
+    assert rv.headers['X-User-Id'] == '2'
+
+    with app.app_context():
+        engine = db.engine
+    with QueryCounter(engine) as counter:
+        rv2 = client.post('/auth/validate', headers=headers)
+    assert rv2.status_code == 200
+    assert rv2.headers['X-User-Id'] == rv.headers['X-User-Id']
+    assert counter.count == 0
+
+
+def test_validate_invalid_api_token(client):
+    headers = {'X-Original-URI': '/api/v1/tahiti/x?api_token=INVALID',
+               'X-Original-Method': 'GET'}
+    rv = client.post('/auth/validate', headers=headers)
+    assert rv.status_code == 401
+
+
+def test_validate_cache_invalidated_on_user_change(client, app):
+    headers = {'X-Original-URI': '/api/v1/tahiti/x?api_token=SOME%20TOKEN',
+               'X-Original-Method': 'GET'}
+    rv = client.post('/auth/validate', headers=headers)
+    assert rv.status_code == 200
+    user_id = int(rv.headers['X-User-Id'])
+
+    admin = {'X-Auth-Token': str(client.secret)}
+    rv = client.post(f'/token/{user_id}', headers=admin)
+    assert rv.status_code == 200
+
+    with app.app_context():
+        engine = db.engine
+    with QueryCounter(engine) as counter:
+        rv = client.post('/auth/validate', headers=headers)
+    assert counter.count > 0
+
+
+def test_validate_openid_token_selects_key_by_kid(client, app):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from thorn.cache import openid_keys
+
+    private_keys = dict((kid, rsa.generate_private_key(65537, 2048))
+                        for kid in ['old', 'new'])
+    public_keys = dict((kid, k.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo).decode('utf8'))
+        for kid, k in private_keys.items())
+    with app.app_context():
+        config = Configuration(
+            name='OPENID_CONFIG', editor='TEXTAREA',
+            value=json.dumps({'enabled': True, 'client_id': 'lemonade'}))
+        db.session.add(config)
+        db.session.add(Configuration(
+            name='OPENID_JWT_PUB_KEY', editor='TEXTAREA',
+            value=json.dumps(public_keys)))
+        db.session.commit()
+        config_id = config.id
+    openid_keys.invalidate(publish=False)
+
+    for kid, status_code in [('old', 200), ('new', 200), ('other', 401)]:
+        token = jwt.encode({'sub': 'openid-user', 'aud': 'lemonade'},
+                           private_keys.get(kid, private_keys['new']),
+                           algorithm='RS256', headers={'kid': kid})
+        rv = client.post('/auth/validate',
+                         headers={'Authorization': f'Bearer {token}'})
+        assert rv.status_code == status_code, kid
+
+    # Disabling OpenID drops cached decisions
+    token = jwt.encode({'sub': 'openid-user', 'aud': 'lemonade'},
+                       private_keys['new'], algorithm='RS256',
+                       headers={'kid': 'new'})
+    rv = client.post('/auth/validate',
+                     headers={'Authorization': f'Bearer {token}'})
+    assert rv.status_code == 200
+    headers = {'X-Auth-Token': str(client.secret)}
+    rv = client.patch('/configurations', headers=headers, json=[
+        {'id': config_id, 'internal': False, 'value': json.dumps(
+            {'enabled': False, 'client_id': 'lemonade'})}])
+    assert rv.status_code == 200, rv.json
+    rv = client.post('/auth/validate',
+                     headers={'Authorization': f'Bearer {token}'})
+    assert rv.status_code == 401
+
+
+def test_unprotected_url_matcher():
+    from thorn.app_auth import UrlMatcher
+    matcher = UrlMatcher({
+        '/api/v1/thorn/auth/login': ['POST'],
+        '/api/v1/thorn/tokens': [],
+        '/api/v1/stand/socket.io*': [],
+        '/api/v1/caipirinha/*/dashboard': ['get'],
+        '/api/v1/tahiti/public/js/tahiti.js': ['GET'],
+    })
+    assert matcher.matches('/api/v1/thorn/auth/login', 'POST')
+    assert not matcher.matches('/api/v1/thorn/auth/login', 'GET')
+    assert matcher.matches('/api/v1/thorn/tokens', 'DELETE')
+    assert matcher.matches('/api/v1/stand/socket.io/', 'GET')
+    assert matcher.matches('/api/v1/stand/socket.io', 'GET')
+    assert matcher.matches('/api/v1/caipirinha/10/dashboard', 'GET')
+    assert not matcher.matches('/api/v1/caipirinha/1/2/dashboard', 'GET')
+    assert matcher.matches('/api/v1/tahiti/public/js/tahiti.js', 'GET')
+    assert matcher.matches('/api/v1/tahiti/public/js/tahiti.js', 'POST')
+    assert matcher.matches('/api/v1/tahiti/public/js/other.js', 'GET')
+    assert not matcher.matches('/api/v1/thorn/users', 'GET')
+
+
+def test_validate_unprotected_url(client):
+    rv = client.post('/auth/validate', headers={
+        'X-Original-URI': '/api/v1/tahiti/public/js/x.js?v=1',
+        'X-Original-Method': 'GET'})
+    assert rv.status_code == 200
+    assert 'X-User-Id' not in rv.headers
+
+
+def test_validate_batch(client, app):
+    with app.app_context():
+        token = jwt.encode({'id': 2}, app.secret_key)
+    data = {'tokens': [
+        token,
+        {'token': 'OTHER TOKEN', 'type': 'api_token'},
+        {'token': 'INVALID', 'type': 'api_token'},
+        {'token': 'INVALID'},
+        123,
+        None,
+        {'token': ['x']},
+    ]}
+    rv = client.post('/auth/validate/batch', json=data)
+    assert rv.status_code == 401
+
+    rv = client.post('/auth/validate/batch', json=data,
+                     headers={'X-Auth-Token': str(client.secret)})
+    assert rv.status_code == 200
+    result = rv.json['data']
+    assert [r['status'] for r in result] == ['OK', 'OK'] + ['ERROR'] * 5
+    assert result[0]['headers']['X-User-Id'] == 2
+
+
+def test_validate_signed_claims(client, app, fake_redis):
+    from thorn.auth_api import _get_jwt_token
+    from thorn.cache import decision_cache
+
+    config = app.config['THORN_CONFIG']
+    config['signed_claims'] = {'enabled': True}
+    try:
+        decision_cache.invalidate_all()
+        with app.app_context():
+            token = _get_jwt_token(User.query.get(2))
+            engine = db.engine
+        headers = {'Authorization': f'Bearer {token}', 'X-THORN-ID': 'true'}
+        with QueryCounter(engine) as counter:
+            rv = client.post('/auth/validate', headers=headers)
+        assert rv.status_code == 200
+        assert rv.headers['X-User-Id'] == '2'
+        assert counter.count == 0
+
+        # Permissions changed: claims are not trusted anymore
+        decision_cache.invalidate_user(2)
+        with QueryCounter(engine) as counter:
+            rv = client.post('/auth/validate', headers=headers)
+        assert rv.status_code == 200
+        assert counter.count > 0
+    finally:
+        del config['signed_claims']
+
+
+def test_permission_version_is_shared(fake_redis):
+    from thorn.cache import AuthDecisionCache
+    issuer, validator = AuthDecisionCache(), AuthDecisionCache()
+    for cache in issuer, validator:
+        cache.enabled = cache.shared = True
+
+    # Not verifiable until a token is issued
+    assert validator.version(2) is None
+    version = issuer.version(2, create=True)
+    assert validator.version(2) == version
+
+    # Invalidated in another process
+    issuer.invalidate_user(2)
+    assert validator.version(2) not in (None, version)
+    version = validator.version(2)
+    issuer.invalidate_all()
+    assert validator.version(2) not in (None, version)
+
+    # Keys lost (eviction, flush): cannot be verified, never restarts
+    version = validator.version(2)
+    from thorn.cache import redis_store
+    redis_store.client.flushall()
+    assert validator.version(2) is None
+    assert issuer.version(2, create=True) != version
+
+
+def test_permission_version_requires_shared_tier(monkeypatch):
+    from thorn.cache import AuthDecisionCache
+    cache = AuthDecisionCache()
+    cache.enabled, cache.shared = True, False
+    cache.invalidate_user(2)
+    assert cache.version(2, create=True) is None
+
+
+def test_validate_returns_permission_mask(client, app):
+    from thorn.auth_api import _get_jwt_token
+    from thorn.authorization import decode_permission_mask, \
+        get_permission_index
+    from thorn.models import Permission
+    with app.app_context():
+        # Ids are sparse, as in the migrations
+        for permission_id in list(range(1, 21)) + list(range(100, 105)):
+            if Permission.query.get(permission_id) is None:
+                db.session.add(Permission(id=permission_id,
+                                          name=f'P{permission_id}',
+                                          applicable_to='SYSTEM'))
+        db.session.commit()
+        get_permission_index(reload=True)
+        token = _get_jwt_token(User.query.get(1))
+    headers = {'Authorization': f'Bearer {token}', 'X-THORN-ID': 'true'}
+    rv = client.post('/auth/validate', headers=headers)
+    assert rv.status_code == 200
+    assert rv.headers['X-Permissions'] == 'ADMINISTRATOR'
+    mask = rv.headers['X-Permission-Mask']
+    assert len(mask) < len('ADMINISTRATOR')
+    with app.app_context():
+        assert decode_permission_mask(mask) == 1 << 25
+        assert decode_permission_mask('ffff:' + mask.split(':')[1]) is None
+
+    # Mapping used by other services
+    rv = client.get('/permissions/mask',
+                    headers={'X-Auth-Token': str(client.secret)})
+    assert rv.json['version'] == mask.split(':')[0]
+    assert rv.json['data'][25] == {'bit': 25, 'id': 1000,
+                                   'name': 'ADMINISTRATOR'}
+
+
+def test_requires_permission_uses_mask(client, app):
+    from thorn.authorization import encode_permission_mask
+    with app.app_context():
+        admin_mask = encode_permission_mask([1000])
+        empty_mask = encode_permission_mask([])
+    headers = {'X-User-Id': '2', 'X-User-Data': 'manager;man@x;Man;pt',
+               'X-Permissions': '',
+               'X-Permission-Mask': admin_mask}
+    rv = client.get('/configurations', headers=headers)
+    assert rv.status_code == 200
+
+    # When the mask is present, permission names are not used
+    headers.update({'X-Permissions': 'ADMINISTRATOR',
+                    'X-Permission-Mask': empty_mask})
+    rv = client.get('/configurations', headers=headers)
+    assert rv.status_code == 401
+
+    del headers['X-Permission-Mask']
+    rv = client.get('/configurations', headers=headers)
+    assert rv.status_code == 200
+
+
+def test_login_uses_password_hashing_pool(client, app):
+    from thorn.hashing import password_hasher
+    from thorn.util import encrypt_password
+    with app.app_context():
+        user = User.query.get(3)
+        user.encrypted_password = encrypt_password('secret').decode('utf8')
+        db.session.commit()
+
+    data = {'user': {'email': 'manager2', 'password': 'secret'}}
+    completed = password_hasher.stats()['completed']
+    rv = client.post('/auth/login', json=data)
+    assert rv.status_code == 200, rv.json
+    assert password_hasher.stats()['completed'] == completed + 1
+
+    # No free slot: fails at once instead of waiting
+    for _ in range(password_hasher.max_pending):
+        password_hasher._slots.acquire()
+    try:
+        rv = client.post('/auth/login', json=data)
+        assert rv.status_code == 503
+        assert rv.headers['Retry-After'] == '1'
+    finally:
+        for _ in range(password_hasher.max_pending):
+            password_hasher._slots.release()
+
+    headers = {'X-Auth-Token': str(client.secret)}
+    rv = client.get('/auth/hashing/stats', headers=headers)
+    assert rv.json['data']['rejected'] >= 1
+
+
+def test_password_hashing_pool_recovers_and_keeps_slots():
+    import time
+    import pytest
+    from thorn.hashing import PasswordHasher, PasswordHashingBusy
+    hasher = PasswordHasher(workers=1, max_pending=1, timeout=0.5)
+    hashed = hasher.hash(b'secret', 4)
+
+    # A worker died: the pool is created again
+    for process in list(hasher._executor._processes.values()):
+        process.kill()
+        process.join()
+    assert hasher.check(b'secret', hashed)
+    assert hasher.stats()['pending'] == 0
+
+    # Caller gave up waiting, but the slot is kept until the end
+    with pytest.raises(PasswordHashingBusy):
+        hasher._run(time.sleep, 1.5)
+    with pytest.raises(PasswordHashingBusy):
+        hasher.check(b'secret', hashed)
+    assert hasher.stats()['rejected'] == 1
+    time.sleep(1.5)
+    assert hasher.check(b'secret', hashed)
+    assert hasher.stats()['pending'] == 0
+    hasher._executor.shutdown()
+
+
+def test_configuration_snapshot(client, app):
+    from thorn.cache import config_snapshot
+    from thorn.util import encrypt_password
+    with app.app_context():
+        user = User.query.get(3)
+        user.encrypted_password = encrypt_password('secret').decode('utf8')
+        config = Configuration(name='SUPPORT_EMAIL', editor='TEXT',
+                               value='support@example.com')
+        db.session.add(config)
+        db.session.commit()
+        config_id = config.id
+        engine = db.engine
+    config_snapshot.invalidate(publish=False)
+
+    data = {'user': {'email': 'manager2', 'password': 'secret'}}
+    rv = client.post('/auth/login', json=data)
+    assert rv.status_code == 200, rv.json
+    with QueryCounter(engine) as counter:
+        rv = client.post('/auth/login', json=data)
+    assert rv.status_code == 200, rv.json
+    assert not [s for s in counter.statements if 'configuration' in s]
+
+    headers = {'X-Auth-Token': str(client.secret)}
+    rv = client.patch('/configurations', headers=headers, json=[
+        {'id': config_id, 'value': 'help@example.com'}])
+    assert rv.status_code == 200, rv.json
+    with app.app_context():
+        assert config_snapshot.get('SUPPORT_EMAIL') == 'help@example.com'
+
+
+def test_ldap_authentication_reuses_connections(app, monkeypatch):
+    import ldap
+    from thorn import ldap_pool, util
+
+    class FakeConnection:
+        down = False
+        binds = 0
+
+        def set_option(self, *args):
+            pass
+
+        def simple_bind_s(self, user_dn, password):
+            FakeConnection.binds += 1
+            if FakeConnection.down:
+                raise ldap.SERVER_DOWN()
+            if password != 'secret':
+                raise ldap.INVALID_CREDENTIALS()
+
+        def search_s(self, base_dn, scope, query):
+            return [('uid=someone', {'mail': [b'someone@x']})]
+
+        def whoami_s(self):
+            return ''
+
+        def unbind_s(self):
+            pass
+
+    connections = []
+
+    def initialize(uri):
+        connections.append(uri)
+        return FakeConnection()
+
+    monkeypatch.setattr(ldap_pool.ldap, 'initialize', initialize)
+    monkeypatch.setattr(util, 'ldap_pools', ldap_pool.LdapPools())
+    config = {'LDAP_SERVER': 'ldap.example', 'LDAP_BASE_DN': 'dc=x',
+              'LDAP_USER_DN': 'uid={login},dc=x'}
+    with app.test_request_context():
+        assert util.ldap_authentication(config, 'someone', 'secret')
+        assert util.ldap_authentication(config, 'someone', 'wrong') is None
+        assert util.ldap_authentication(config, 'someone', 'secret')
+        assert connections == ['ldap://ldap.example']
+
+        FakeConnection.down = True
+        for _ in range(3):
+            assert util.ldap_authentication(config, 'x', 'secret') is None
+        binds = FakeConnection.binds
+        # Circuit is open: fails without contacting the server
+        assert util.ldap_authentication(config, 'x', 'secret') is None
+        assert FakeConnection.binds == binds
+
+
+def test_configuration_snapshot_invalidated_by_redis(app, fake_redis):
+    from thorn.cache import config_snapshot, redis_store
+    with app.app_context():
+        config = Configuration(name='SERVER_BASE_URL', editor='TEXT',
+                               value='http://old')
+        db.session.add(config)
+        db.session.commit()
+        config_snapshot.invalidate(publish=False)
+        assert config_snapshot.get('SERVER_BASE_URL') == 'http://old'
+        assert _wait_for(lambda: redis_store._listener is not None)
+
+        # Changed by another process, which publishes the invalidation
+        config.value = 'http://new'
+        db.session.commit()
+        assert config_snapshot.get('SERVER_BASE_URL') == 'http://old'
+        redis_store.client.publish(config_snapshot.CHANNEL, 'configuration')
+        assert _wait_for(lambda: config_snapshot._checked == 0)
+        assert config_snapshot.get('SERVER_BASE_URL') == 'http://new'
+
+
+def test_public_configuration_etag(client, app):
+    from thorn.cache import config_snapshot
+    with app.app_context():
+        config = Configuration(name='UI_THEME', editor='TEXTAREA',
+                               internal=False, value='{"color": "blue"}')
+        db.session.add(config)
+        db.session.add(Configuration(name='UI_SECRET', editor='TEXT',
+                                     internal=True, value='{}'))
+        db.session.commit()
+        config_id = config.id
+        engine = db.engine
+    config_snapshot.invalidate(publish=False)
+
+    rv = client.get('/public/configurations/UI_THEME')
+    assert rv.status_code == 200
+    assert rv.json == {'data': {'color': 'blue'}}
+    etag = rv.headers['ETag']
+    assert not etag.startswith('W/')
+    assert 'public' in rv.headers['Cache-Control']
+
+    with QueryCounter(engine) as counter:
+        rv = client.get('/public/configurations/UI_THEME',
+                        headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert counter.count == 0
+
+    assert client.get('/public/configurations/UI_SECRET').status_code == 404
+
+    headers = {'X-Auth-Token': str(client.secret)}
+    rv = client.patch('/configurations', headers=headers, json=[
+        {'id': config_id, 'value': '{"color": "red"}', 'internal': False}])
+    assert rv.status_code == 200, rv.json
+    rv = client.get('/public/configurations/UI_THEME',
+                    headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.json == {'data': {'color': 'red'}}
+    assert rv.headers['ETag'] != etag
+
+
+def _wait_for(condition, timeout=3):
+    import time
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def test_shared_auth_cache(fake_redis):
+    from thorn.cache import AuthDecisionCache, TTLCache, redis_store
+    this, other = AuthDecisionCache(), AuthDecisionCache()
+    for cache in this, other:
+        cache.enabled = cache.shared = True
+        cache._entries = TTLCache()
+    key = AuthDecisionCache.key('api_token', 'SOME TOKEN')
+
+    # Computed by a process, used by another one
+    this.set(key, 2, {'X-User-Id': 2})
+    assert other.get(key) == {'X-User-Id': 2}
+
+    # Generation bump: shared entries computed before are not used
+    this.invalidate_all()
+    other._entries.clear()
+    assert other.get(key) is None
+    this.set(key, 2, {'X-User-Id': 2})
+    assert other.get(key) == {'X-User-Id': 2}
+
+    # Invalidation published to the other process drops its local entry
+    redis_store.subscribe(AuthDecisionCache.CHANNEL, other._on_invalidate)
+    assert redis_store.client is not None
+    assert _wait_for(lambda: redis_store._listener is not None)
+    other._entries.set(key, (2, {'X-User-Id': 2}))
+    this.invalidate_user(2)
+    assert _wait_for(lambda: len(other._entries) == 0)
+    assert other.get(key) is None
+
+    # User changed while the decision was computed: it is not stored
+    assert this.get(key) is None
+    this.invalidate_user(2)
+    this.set(key, 2, {'X-User-Id': 2})
+    assert this.get(key) is None
+    assert other.get(key) is None
+
+    # Another user changed: the decision is stored
+    assert this.get(key) is None
+    this.invalidate_user(3)
+    this.set(key, 2, {'X-User-Id': 2})
+    assert other.get(key) == {'X-User-Id': 2}
+
+
+def test_shared_auth_cache_redis_down(fake_redis):
+    from thorn.cache import AuthDecisionCache, TTLCache, redis_store
+    cache = AuthDecisionCache()
+    cache.enabled = cache.shared = True
+    cache._entries = TTLCache()
+    key = AuthDecisionCache.key('api_token', 'SOME TOKEN')
+
+    fake_redis.connected = False
+    # Only the local tier is used, errors are not raised
+    cache.set(key, 2, {'X-User-Id': 2})
+    assert cache.get(key) == {'X-User-Id': 2}
+    cache.invalidate_user(2)
+    assert cache.get(key) is None
+    assert cache.version(2, create=True) is None
+    # Redis is not tried again for a while
+    assert redis_store.client is None
@@ -0,0 +1,261 @@
+from .conftest import *
+from flask import current_app
+
+
+def test_unread_count_is_maintained(client):
+    headers = {'X-Auth-Token': str(client.secret)}
+    rv = client.get('/notifications/summary', headers=headers)
+    assert rv.status_code == 200
+    unread = rv.json['unread']
+    etag = client.get('/users/1', headers=headers).headers['ETag']
+
+    rv = client.post('/notifications', headers=headers,
+                     json={'text': 'Job finished'})
+    assert rv.status_code == 200, rv.json
+    notification_id = rv.json['id']
+    rv = client.get('/notifications/summary', headers=headers)
+    assert rv.json['unread'] == unread + 1
+
+    rv = client.patch(f'/notifications/{notification_id}', headers=headers,
+                      json={'status': 'READ'})
+    assert rv.status_code == 200, rv.json
+    rv = client.get('/notifications/summary', headers=headers)
+    assert rv.json['unread'] == unread
+
+    rv = client.patch(f'/notifications/{notification_id}', headers=headers,
+                      json={'status': 'UNREAD'})
+    rv = client.delete(f'/notifications/{notification_id}', headers=headers)
+    assert rv.status_code == 200, rv.json
+    rv = client.get('/notifications/summary', headers=headers)
+    assert rv.json['unread'] == unread
+
+    # The counter does not change the user (updated_at, ETag)
+    assert client.get('/users/1', headers=headers).headers['ETag'] == etag
+
+
+def test_bulk_notifications(client):
+    headers = {'X-Auth-Token': str(client.secret)}
+    rv = client.get('/notifications/summary', headers=headers)
+    unread = rv.json['unread']
+    etag = client.get('/users/1', headers=headers).headers['ETag']
+
+    rv = client.post('/notifications/bulk', headers=headers, json={
+        'notifications': [{'text': f'Message {i}', 'user_id': 1}
+                          for i in range(3)]})
+    assert rv.status_code == 200, rv.json
+    assert rv.json['count'] == 3
+    rv = client.get('/notifications/summary', headers=headers)
+    assert rv.json['unread'] == unread + 3
+    assert client.get('/users/1', headers=headers).headers['ETag'] == etag
+
+    rv = client.post('/notifications/bulk', headers=headers, json={
+        'notification': {'text': 'Maintenance'}, 'all_users': True})
+    assert rv.status_code == 200, rv.json
+    assert rv.json['count'] >= 1
+    rv = client.get('/notifications/summary', headers=headers)
+    assert rv.json['unread'] == unread + 4
+
+    rv = client.post('/notifications/bulk', headers=headers, json={
+        'notifications': [{'text': 'No user'}]})
+    assert rv.status_code == 400
+
+    rv = client.post('/notifications/bulk', headers=headers, json={
+        'notification': {'text': 'Nobody'}, 'role_id': 999999})
+    assert rv.status_code == 404
+
+
+def test_bulk_notifications_in_batches(client, app, monkeypatch):
+    from thorn import notification_api
+    emitted = []
+    monkeypatch.setattr(notification_api.NotificationBulkApi, 'BATCH_SIZE', 1)
+    monkeypatch.setattr(notification_api.emitter, 'emit_many',
+                        lambda config, event, items: emitted.extend(items))
+    headers = {'X-Auth-Token': str(client.secret)}
+    rv = client.post('/notifications/bulk', headers=headers, json={
+        'notification': {'text': 'Batches'}, 'all_users': True})
+    assert rv.status_code == 200, rv.json
+
+    with app.app_context():
+        expected = dict((f'users/{user_id}', unread) for user_id, unread in
+                        db.session.query(User.id, User.unread_notifications
+                                         ).filter(User.enabled))
+    assert rv.json['count'] == len(expected) > 1
+    assert dict((room, data['unread']) for data, room in emitted) == expected
+
+
+def test_change_many_notifications(client):
+    headers = {'X-Auth-Token': str(client.secret)}
+    ids = []
+    for i in range(3):
+        rv = client.post('/notifications', headers=headers,
+                         json={'text': f'Job {i} finished'})
+        ids.append(rv.json['id'])
+
+    rv = client.patch('/notifications', headers=headers,
+                      json={'ids': ids[:2], 'status': 'READ'})
+    assert rv.status_code == 200, rv.json
+    assert rv.json['count'] == 2
+
+    rv = client.patch('/notifications', headers=headers, json={
+        'filter': {'status': 'UNREAD', 'before': '2999-01-01T00:00:00'},
+        'status': 'READ'})
+    assert rv.status_code == 200, rv.json
+    assert rv.json['count'] >= 1
+    rv = client.get('/notifications/summary', headers=headers)
+    assert rv.json['unread'] == 0
+
+    rv = client.delete('/notifications', headers=headers, json={'ids': ids})
+    assert rv.status_code == 200, rv.json
+    assert rv.json['count'] == 3
+    rv = client.get(f'/notifications/{ids[0]}', headers=headers)
+    assert rv.status_code == 404
+
+    rv = client.patch('/notifications', headers=headers,
+                      json={'filter': {'before': 'yesterday'},
+                            'status': 'READ'})
+    assert rv.status_code == 400
+
+
+def test_list_notifications_with_cursor(client):
+    headers = {'X-Auth-Token': str(client.secret)}
+    for i in range(5):
+        client.post('/notifications', headers=headers,
+                    json={'text': f'Cursor {i}'})
+    rv = client.get('/notifications?sort=id&page=1&size=1000',
+                    headers=headers)
+    expected = [n['id'] for n in rv.json['data']]
+
+    ids = []
+    rv = client.get('/notifications?sort=id&size=2&after=', headers=headers)
+    assert rv.status_code == 200, rv.json
+    assert rv.json['pagination']['previous'] is None
+    while True:
+        ids.extend(n['id'] for n in rv.json['data'])
+        cursor = rv.json['pagination']['next']
+        if cursor is None:
+            break
+        rv = client.get(f'/notifications?sort=id&size=2&after={cursor}',
+                        headers=headers)
+    assert ids == expected
+
+    rv = client.get('/notifications?sort=id&size=2&before=', headers=headers)
+    assert [n['id'] for n in rv.json['data']] == expected[-2:]
+    cursor = rv.json['pagination']['previous']
+    rv = client.get(f'/notifications?sort=id&size=2&before={cursor}',
+                    headers=headers)
+    assert [n['id'] for n in rv.json['data']] == expected[-4:-2]
+
+    rv = client.get('/notifications?after=invalid', headers=headers)
+    assert rv.status_code == 400
+    rv = client.get('/notifications?sort=created&after=WzEyMywxXQ==',
+                    headers=headers)
+    assert rv.status_code == 400
+
+
+def test_list_notifications_count_modes(client):
+    headers = {'X-Auth-Token': str(client.secret)}
+    for i in range(3):
+        client.post('/notifications', headers=headers,
+                    json={'text': f'Count {i}'})
+    rv = client.get('/notifications?page=1&size=1000', headers=headers)
+    total = rv.json['pagination']['total']
+    assert total == len(rv.json['data'])
+
+    rv = client.get('/notifications?page=1&size=2&count=none',
+                    headers=headers)
+    assert rv.status_code == 200, rv.json
+    assert rv.json['pagination']['total'] is None
+    assert rv.json['pagination']['has_next'] is True
+
+    for mode in ('exact', 'estimate'):
+        rv = client.get(f'/notifications?page=1&size=2&count={mode}',
+                        headers=headers)
+        assert rv.status_code == 200, rv.json
+        assert rv.json['pagination']['total'] == total
+        assert len(rv.json['data']) == 2
+
+
+class FakeRedisManager:
+    instances = []
+
+    def __init__(self, url, channel, write_only=False):
+        self.url = url
+        self.emitted = []
+        FakeRedisManager.instances.append(self)
+
+    def emit(self, event, data, room=None, namespace=None):
+        if data.get('fail'):
+            raise ConnectionError('Redis is down')
+        self.emitted.append((event, data, room, namespace))
+
+
+def _wait_for(condition, timeout=3):
+    import time
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_emitter_sends_batches_in_background(monkeypatch):
+    from thorn import notification_api
+    monkeypatch.setattr(notification_api.socketio, 'RedisManager',
+                        FakeRedisManager)
+    FakeRedisManager.instances = []
+    emitter = notification_api.NotificationEmitter()
+    config = {'servers': {'redis_url': 'redis://redis/1'}}
+
+    emitter.emit_many(config, 'notifications', [
+        ({'fail': True}, 'users/1'), ({'unread': 1}, 'users/2'),
+        ({'unread': 5}, 'users/3')])
+    emitter.emit(config, 'notifications', {'unread': 2}, room='users/2')
+
+    manager, = FakeRedisManager.instances
+    assert manager.url == 'redis://redis'
+    # An error in an item does not stop the others
+    assert _wait_for(lambda: len(manager.emitted) == 3)
+    assert manager.emitted == [
+        ('notifications', {'unread': 1}, 'users/2', '/stand'),
+        ('notifications', {'unread': 5}, 'users/3', '/stand'),
+        ('notifications', {'unread': 2}, 'users/2', '/stand')]
+
+
+def test_emitter_restarts_after_fork(monkeypatch):
+    import threading
+    from thorn import notification_api
+    monkeypatch.setattr(notification_api.socketio, 'RedisManager',
+                        FakeRedisManager)
+    FakeRedisManager.instances = []
+    emitter = notification_api.NotificationEmitter()
+    config = {'servers': {'redis_url': 'redis://redis'}}
+
+    def threads():
+        return [t for t in threading.enumerate()
+                if t.name == 'notification-emitter']
+
+    before = len(threads())
+    emitter.emit(config, 'notifications', {'unread': 1}, room='users/1')
+    emitter.emit(config, 'notifications', {'unread': 2}, room='users/1')
+    assert len(FakeRedisManager.instances) == 1
+    assert len(threads()) == before + 1
+
+    # Threads are not inherited by a forked child: it starts its own
+    monkeypatch.setattr(notification_api.os, 'getpid',
+                        lambda: emitter._pid + 1)
+    emitter.emit(config, 'notifications', {'unread': 3}, room='users/1')
+    parent, child = FakeRedisManager.instances
+    assert len(threads()) == before + 2
+    assert _wait_for(lambda: len(child.emitted) == 1)
+    assert child.emitted[0][1] == {'unread': 3}
+    assert _wait_for(lambda: len(parent.emitted) == 2)
+
+
+def test_socketio_redis_url():
+    from thorn.notification_api import _get_socketio_url
+    assert _get_socketio_url(
+        {'servers': {'redis_url': 'redis://redis/1'}}) == 'redis://redis'
+    assert _get_socketio_url(
+        {'servers': {'redis_url': 'redis://redis/2'}}) == 'redis://redis/2'
+    assert _get_socketio_url({'servers': {
+        'redis_url': 'redis://redis/1',
+        'socketio_redis_url': 'redis://stand/3'}}) == 'redis://stand/3'
@@ -38,3 +38,154 @@ def test_post_role_invalid_form(client):
     
     assert rv.status_code == 400
 
+
+
+def test_get_role_users(client):
+    headers = {'X-Auth-Token': str(client.secret)}
+    rv = client.get('/roles/1', headers=headers)
+    assert rv.status_code == 200
+    role = rv.json['data'][0]
+    assert 'users' not in role
+    assert role['users_count'] == 1
+
+    rv = client.get('/roles/1/users', headers=headers)
+    assert rv.status_code == 200, rv.json
+    assert [u['id'] for u in rv.json['data']] == [1]
+    assert rv.json['pagination']['total'] == 1
+    assert 'roles' not in rv.json['data'][0]
+
+    rv = client.get('/roles/1/users?after=', headers=headers)
+    assert rv.status_code == 200, rv.json
+    assert [u['id'] for u in rv.json['data']] == [1]
+    assert rv.json['pagination']['next'] is None
+
+    rv = client.get('/roles/200/users', headers=headers)
+    assert rv.status_code == 404
+
+
+def test_change_role_members(client):
+    headers = {'X-Auth-Token': str(client.secret)}
+    rv = client.post('/roles', headers=headers, json={
+        'name': 'members', 'description': 'Members', 'enabled': True,
+        'users': [{'id': 2}], 'permissions': [{'id': 1000}]})
+    assert rv.status_code == 200, rv.json
+    role_id = rv.json['id']
+
+    def get_members():
+        rv = client.get(f'/roles/{role_id}/users?size=100', headers=headers)
+        return sorted(u['id'] for u in rv.json['data'])
+
+    assert get_members() == [2]
+
+    rv = client.post(f'/roles/{role_id}/users', headers=headers,
+                     json={'ids': [2, 3, 999999]})
+    assert rv.status_code == 200, rv.json
+    assert rv.json['added'] == 1
+    assert get_members() == [2, 3]
+
+    rv = client.delete(f'/roles/{role_id}/users', headers=headers,
+                       json={'ids': [2]})
+    assert rv.json['removed'] == 1
+    assert get_members() == [3]
+
+    # Associations missing in the request are not changed
+    rv = client.patch(f'/roles/{role_id}', headers=headers,
+                      json={'description': 'Changed'})
+    assert rv.status_code == 200, rv.json
+    assert get_members() == [3]
+    assert [p['id'] for p in rv.json['data'][0]['permissions']] == [1000]
+
+    rv = client.patch(f'/roles/{role_id}', headers=headers,
+                      json={'users': [{'id': 1}, {'id': 2}],
+                            'permissions': []})
+    assert rv.status_code == 200, rv.json
+    assert get_members() == [1, 2]
+    assert rv.json['data'][0]['permissions'] == []
+
+    rv = client.post(f'/roles/{role_id}/permissions', headers=headers,
+                     json={'ids': [1000]})
+    assert rv.json['added'] == 1
+
+    rv = client.post(f'/roles/{role_id}/users', headers=headers,
+                     json={'ids': ['x']})
+    assert rv.status_code == 400
+
+    # Only administrators change members and permissions
+    user = {'X-User-Id': '3', 'X-Permissions': '',
+            'X-User-Data': 'manager2;man2@lemonade.org.br;Manager2;pt'}
+    for kind, ids in [('users', [3]), ('permissions', [1000])]:
+        for method in [client.post, client.delete]:
+            rv = method(f'/roles/{role_id}/{kind}', headers=user,
+                        json={'ids': ids})
+            assert rv.status_code == 401, (kind, method)
+    assert get_members() == [1, 2]
+    rv = client.get(f'/roles/{role_id}', headers=headers)
+    assert [p['id'] for p in rv.json['data'][0]['permissions']] == [1000]
+
+
+def test_effective_permissions_follow_role_changes(client, app):
+    from thorn.authorization import get_user_permissions
+    headers = {'X-Auth-Token': str(client.secret)}
+
+    def permissions():
+        with app.app_context():
+            return [name for _, name in get_user_permissions(3)]
+
+    rv = client.post('/roles', headers=headers, json={
+        'name': 'effective', 'description': 'Effective', 'enabled': True,
+        'users': [{'id': 3}], 'permissions': [{'id': 1000}]})
+    assert rv.status_code == 200, rv.json
+    role_id = rv.json['id']
+    assert permissions() == ['ADMINISTRATOR']
+
+    rv = client.patch(f'/roles/{role_id}', headers=headers,
+                      json={'enabled': False})
+    assert rv.status_code == 200, rv.json
+    assert permissions() == []
+
+    client.patch(f'/roles/{role_id}', headers=headers,
+                 json={'enabled': True})
+    assert permissions() == ['ADMINISTRATOR']
+
+    client.delete(f'/roles/{role_id}/permissions', headers=headers,
+                  json={'ids': [1000]})
+    assert permissions() == []
+
+    client.post(f'/roles/{role_id}/permissions', headers=headers,
+                json={'ids': [1000]})
+    client.delete(f'/roles/{role_id}/users', headers=headers,
+                  json={'ids': [3]})
+    assert permissions() == []
+
+    client.post(f'/roles/{role_id}/users', headers=headers,
+                json={'ids': [3]})
+    assert permissions() == ['ADMINISTRATOR']
+    rv = client.delete(f'/roles/{role_id}', headers=headers)
+    assert rv.status_code == 200, rv.json
+    assert permissions() == []
+
+
+def test_get_role_etag(client, app):
+    headers = {'X-Auth-Token': str(client.secret)}
+    rv = client.get('/roles/101', headers=headers)
+    assert rv.status_code == 200
+    etag = rv.headers['ETag']
+
+    with app.app_context():
+        engine = db.engine
+    with QueryCounter(engine) as counter:
+        rv = client.get('/roles/101',
+                        headers=dict(headers, **{'If-None-Match': etag}))
+    assert rv.status_code == 304
+    # Only the authenticated user and the version are read
+    assert counter.count == 2
+    assert not [s for s in counter.statements if 'translation' in s]
+
+    # Members are part of the details (users_count)
+    rv = client.post('/roles/101/users', headers=headers, json={'ids': [3]})
+    assert rv.status_code == 200, rv.json
+    rv = client.get('/roles/101',
+                    headers=dict(headers, **{'If-None-Match': etag}))
+    assert rv.status_code == 200
+    assert rv.headers['ETag'] != etag
+    client.delete('/roles/101/users', headers=headers, json={'ids': [3]})
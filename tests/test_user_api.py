@@ -30,6 +30,95 @@ def test_get_users_filter(client):
     assert rv.json['pagination']['total'] == 2
     assert rv.status_code == 200
 
+def test_get_users_with_cursor(client):
+    headers = {'X-Auth-Token': str(client.secret)}
+    ids = []
+    rv = client.get('/users?sort=confirmed_at&asc=false&size=1&after=',
+                    headers=headers)
+    while True:
+        assert rv.status_code == 200, rv.json
+        assert 'total' not in rv.json['pagination']
+        ids.extend(u['id'] for u in rv.json['data'])
+        cursor = rv.json['pagination']['next']
+        if cursor is None:
+            break
+        rv = client.get(
+            f'/users?sort=confirmed_at&asc=false&size=1&after={cursor}',
+            headers=headers)
+    assert sorted(ids) == [1, 2, 3]
+
+    # Values of another type are rejected
+    import base64
+    for value in [[123, 1], [[1], 1], ['2020-01-01', 'x']]:
+        cursor = base64.urlsafe_b64encode(
+            json.dumps(value).encode('utf8')).decode('ascii')
+        rv = client.get(f'/users?sort=confirmed_at&size=1&after={cursor}',
+                        headers=headers)
+        assert rv.status_code == 400, value
+
+def test_get_users_projection(client, app):
+    headers = {'X-Auth-Token': str(client.secret)}
+    with app.app_context():
+        engine = db.engine
+    with QueryCounter(engine) as counter:
+        rv = client.get('/users?fields=id,first_name&sort=id',
+                        headers=headers)
+    assert rv.status_code == 200
+    assert set(rv.json['data'][0].keys()) == {'id', 'first_name'}
+    # The first statements load the authenticated user
+    list_queries = [s for s in counter.statements if 'LIMIT' in s]
+    assert len(list_queries) == 1
+    assert 'user.email' not in list_queries[0]
+    assert 'user.workspace_id' not in list_queries[0]
+    # No relationship (roles, workspace) is loaded
+    position = counter.statements.index(list_queries[0])
+    assert not any('user_role' in s or 'workspace' in s
+                   for s in counter.statements[position:])
+
+def test_get_users_query_count_is_constant(client, app):
+    from thorn.models import RoleTranslation
+    headers = {'X-Auth-Token': str(client.secret)}
+    sizes = (1, 3)
+    # Each user has its own roles, with translations, so loading them
+    # lazily would add statements for every row
+    with app.app_context():
+        engine = db.engine
+        users = User.query.order_by(User.id).limit(max(sizes)).all()
+        roles = []
+        for user in users:
+            for i in range(2):
+                role = Role(name=f'count {user.id} {i}', enabled=True,
+                            users=[user])
+                for locale in ('pt', 'en'):
+                    role.translations[locale].label = f'{locale} {i}'
+                    role.translations[locale].description = locale
+                db.session.add(role)
+                roles.append(role)
+        db.session.commit()
+        role_ids = [role.id for role in roles]
+
+    try:
+        counts = []
+        for size in sizes:
+            with QueryCounter(engine) as counter:
+                # No COUNT(*), which depends on having a next page
+                rv = client.get(f'/users?size={size}&sort=id&count=none',
+                                headers=headers)
+            assert rv.status_code == 200
+            assert len(rv.json['data']) == size
+            assert all(len(u['roles']) >= 2 for u in rv.json['data'])
+            counts.append(counter.count)
+        assert counts[0] == counts[1]
+    finally:
+        with app.app_context():
+            for role in Role.query.filter(Role.id.in_(role_ids)):
+                role.users = []
+                db.session.delete(role)
+            RoleTranslation.query.filter(
+                RoleTranslation.id.in_(role_ids)).delete(
+                    synchronize_session=False)
+            db.session.commit()
+
 def test_get_user(client):
     headers = {'X-Auth-Token': str(client.secret)}
     user_id = 2
@@ -41,6 +130,32 @@ def test_get_user(client):
     assert d1['login'] == 'manager'
 
 
+def test_get_user_etag(client, app):
+    headers = {'X-Auth-Token': str(client.secret)}
+    rv = client.get('/users/3', headers=headers)
+    assert rv.status_code == 200
+    etag = rv.headers['ETag']
+
+    with app.app_context():
+        engine = db.engine
+    with QueryCounter(engine) as counter:
+        rv = client.get('/users/3',
+                        headers=dict(headers, **{'If-None-Match': etag}))
+    assert rv.status_code == 304
+    # Only the authenticated user and the version are read
+    assert counter.count == 2
+    assert not [s for s in counter.statements if 'translation' in s]
+
+    # Roles are part of the details
+    rv = client.post('/roles/101/users', headers=headers, json={'ids': [3]})
+    assert rv.status_code == 200, rv.json
+    rv = client.get('/users/3',
+                    headers=dict(headers, **{'If-None-Match': etag}))
+    assert rv.status_code == 200
+    assert rv.headers['ETag'] != etag
+    client.delete('/roles/101/users', headers=headers, json={'ids': [3]})
+
+
 def test_delete_user(client, app):
     user_id = 1000
     with app.app_context():
@@ -58,7 +173,7 @@ def test_delete_user(client, app):
         last_name='Man',
         locale='pt',
         confirmed_at=datetime.datetime.now(),
-        api_token='SOME TOKEN')
+        api_token='THIRD TOKEN')
 
         db.session.add(u3)
         db.session.commit()
@@ -141,3 +256,173 @@ def test_post_user_success(client):
             if k not in ['password']:
                 assert getattr(user, k) == v
 
+
+def test_post_user_with_roles(client, app):
+    from thorn.authorization import get_user_permissions
+    headers = {'X-Auth-Token': str(client.secret)}
+    rv = client.post('/roles', headers=headers, json={
+        'name': 'new user role', 'description': 'New user role',
+        'enabled': True, 'permissions': [{'id': 1000}]})
+    assert rv.status_code == 200, rv.json
+    role_id = rv.json['id']
+
+    email = 'with.roles@lemonade.org.br'
+    rv = client.post('/users', headers=headers, json={
+        'first_name': 'With', 'last_name': 'Roles', 'password': 'dummy',
+        'email': email, 'roles': [{'id': role_id}]})
+    assert rv.status_code == 200, rv.json
+    user_id = rv.json['data']['id']
+    with app.app_context():
+        assert [name for _, name in get_user_permissions(user_id)] == [
+            'ADMINISTRATOR']
+
+    # Users registering themselves cannot choose roles
+    email = 'self.registered@lemonade.org.br'
+    rv = client.post('/register', json={
+        'first_name': 'Self', 'last_name': 'Registered', 'password': 'dummy',
+        'email': email, 'roles': [{'id': role_id}]})
+    assert rv.status_code == 200, rv.json
+    with app.app_context():
+        user = User.query.filter(User.email == email).one()
+        assert user.roles == []
+        assert get_user_permissions(user.id) == []
+def test_password_hashing_busy(client, app, monkeypatch):
+    from thorn.hashing import password_hasher
+    # Not testing: flask_restful would answer unhandled exceptions with 500
+    monkeypatch.setitem(app.config, 'PROPAGATE_EXCEPTIONS', False)
+    headers = {'X-Auth-Token': str(client.secret)}
+    email = 'busy@lemonade.org.br'
+
+    for _ in range(password_hasher.max_pending):
+        password_hasher._slots.acquire()
+    try:
+        rv = client.post('/register', json={
+            'first_name': 'Busy', 'last_name': 'User', 'email': email,
+            'password': 'secret'})
+        assert rv.status_code == 503, rv.json
+        assert rv.headers['Retry-After'] == '1'
+        assert rv.json['status'] == 'ERROR'
+
+        rv = client.patch('/users/2', headers=headers, json={
+            'password': 'new secret',
+            'password_confirmation': 'new secret'})
+        assert rv.status_code == 503, rv.json
+        assert rv.headers['Retry-After'] == '1'
+    finally:
+        for _ in range(password_hasher.max_pending):
+            password_hasher._slots.release()
+
+    with app.app_context():
+        assert User.query.filter(User.email == email).first() is None
+        assert User.query.get(2).encrypted_password == 'xyuasdasdkjkl'
+
+
+
+def test_send_email_reuses_smtp_sessions(app, monkeypatch):
+    import smtplib
+    from thorn import jobs, smtp_pool
+    from thorn.cache import config_snapshot
+    from thorn.models import Configuration
+
+    class FakeSMTP:
+        drop = False
+        sent = []
+
+        def __init__(self, host, port, timeout=None):
+            connections.append((host, port))
+
+        def ehlo(self):
+            pass
+
+        def login(self, user, password):
+            assert (user, password) == ('mailer', 'secret')
+
+        def noop(self):
+            return 250, b'OK'
+
+        def sendmail(self, sender, to, message):
+            if to == ['rejected@example.com']:
+                raise smtplib.SMTPRecipientsRefused(
+                    {to[0]: (550, b'No such user')})
+            if FakeSMTP.drop:
+                FakeSMTP.drop = False
+                raise smtplib.SMTPServerDisconnected()
+            FakeSMTP.sent.append(to)
+
+        def quit(self):
+            pass
+
+    connections = []
+    monkeypatch.setattr(smtp_pool.smtplib, 'SMTP_SSL', FakeSMTP)
+    monkeypatch.setattr(jobs, 'smtp_pools', smtp_pool.SmtpPools())
+    with app.app_context():
+        for name, value in [('SMTP_SERVER', 'smtp.example'),
+                            ('SMTP_PORT', '465'), ('SMTP_USER', 'mailer'),
+                            ('SMTP_PASSWORD', 'secret')]:
+            db.session.add(Configuration(name=name, value=value,
+                                         editor='TEXT'))
+        db.session.commit()
+    config_snapshot.invalidate(publish=False)
+
+    with app.test_request_context():
+        for i in range(3):
+            jobs.send_email(subject='Hi', to=f'user{i}@example.com',
+                            name='User', template='confirm', link='')
+        assert connections == [('smtp.example', '465')]
+        assert len(FakeSMTP.sent) == 3
+
+        # Session closed by the server: message is sent using a new one
+        FakeSMTP.drop = True
+        jobs.send_email(subject='Hi', to='user@example.com', name='User',
+                        template='confirm', link='')
+        assert len(connections) == 2
+        assert FakeSMTP.sent[-1] == ['user@example.com']
+
+        # Permanent error: not sent again and the session is kept
+        with pytest.raises(smtplib.SMTPRecipientsRefused):
+            jobs.send_email(subject='Hi', to='rejected@example.com',
+                            name='User', template='confirm', link='')
+        jobs.send_email(subject='Hi', to='other@example.com', name='User',
+                        template='confirm', link='')
+        assert len(connections) == 2
+        assert FakeSMTP.sent[-1] == ['other@example.com']
+
+
+def test_get_users_with_cursor_on_nullable_column(client, app):
+    headers = {'X-Auth-Token': str(client.secret)}
+    # Registered users are not confirmed (confirmed_at is NULL)
+    for name in ['null1', 'null2']:
+        rv = client.post('/register', json={
+            'first_name': name, 'password': 'dummy',
+            'email': f'{name}@lemonade.org.br'})
+        assert rv.status_code == 200, rv.json
+
+    def walk(asc, direction):
+        ids = []
+        url = f'/users?sort=confirmed_at&asc={asc}&size=2&{direction}='
+        rv = client.get(url, headers=headers)
+        while True:
+            assert rv.status_code == 200, rv.json
+            page = [u['id'] for u in rv.json['data']]
+            ids = ids + page if direction == 'after' else page + ids
+            cursor = rv.json['pagination'][
+                'next' if direction == 'after' else 'previous']
+            if cursor is None:
+                return ids
+            rv = client.get(url + cursor, headers=headers)
+
+    with app.app_context():
+        engine = db.engine
+        rows = User.query.with_entities(User.id, User.confirmed_at).all()
+    assert any(confirmed is None for _, confirmed in rows)
+    # SQLite sorts NULLs first
+    expected = [user_id for user_id, _ in sorted(
+        rows, key=lambda r: (r[1] is not None, r[1] or 0, r[0]))]
+
+    with QueryCounter(engine) as counter:
+        for asc, order in [('true', expected),
+                           ('false', list(reversed(expected)))]:
+            assert walk(asc, 'after') == order
+            assert walk(asc, 'before') == order
+    # Conditions on the sort column must be able to use its index
+    assert not any('coalesce' in s.lower() for s in counter.statements)
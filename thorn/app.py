@@ -8,24 +8,45 @@ import sqlalchemy_utils
 import yaml
 from flask_migrate import Migrate
 from thorn import rq
-from flask import Flask, request
+from thorn.cache import config_snapshot, decision_cache, redis_store
+from thorn.hashing import PasswordHashingBusy, password_hasher
+from thorn.ldap_pool import ldap_pools
+from thorn.smtp_pool import smtp_pools
+from flask import Flask, current_app, request
 from flask_babel import get_locale, Babel
 from flask_cors import CORS
 from flask_restful import Api
 from flask_swagger_ui import get_swaggerui_blueprint
+from thorn.app_auth import UrlMatcher
 from thorn.gateway import ApiGateway
 from thorn.models import db, User
-from thorn.permission_api import PermissionListApi
+from thorn.permission_api import PermissionListApi, PermissionMaskApi
 from thorn.user_api import UserListApi, \
     ResetPasswordApi, ApproveUserApi, UserDetailApi, ProfileApi, \
     RegisterApi, GenerateUserTokenApi
-from thorn.auth_api import ValidateTokenApi, AuthenticationApi
-from thorn.role_api import RoleListApi, RoleDetailApi
+from thorn.auth_api import ValidateTokenApi, AuthenticationApi, \
+    ValidateTokenBatchApi, PasswordHashingStatsApi, \
+    handle_password_hashing_busy
+from thorn.role_api import RoleListApi, RoleDetailApi, RoleUserListApi, \
+    RolePermissionListApi
 from thorn.notification_api import NotificationListApi, NotificationDetailApi, \
-    NotificationSummaryApi
+    NotificationSummaryApi, NotificationBulkApi
 from thorn.configuration_api import (ConfigurationListApi, 
     UserInterfaceConfigurationDetailApi)
 
+
+class ThornApi(Api):
+    """
+    Exceptions with an error handler registered in Flask are left to it,
+    otherwise flask_restful answers them with 500 (outside tests).
+    """
+    def handle_error(self, e):
+        handlers = current_app.error_handler_spec[None][None]
+        if any(isinstance(e, cls) for cls in handlers):
+            raise e
+        return super().handle_error(e)
+
+
 def create_app(is_main_module=False):
     
     app = Flask(__name__)
@@ -50,23 +71,31 @@ def create_app(is_main_module=False):
     
     app.register_blueprint(swaggerui_blueprint)
 
-    api = Api(app)
+    api = ThornApi(app)
+    app.register_error_handler(PasswordHashingBusy,
+                               handle_password_hashing_busy)
     
     mappings = {
         '/approve/<int:user_id>': ApproveUserApi,
         '/auth/validate': ValidateTokenApi,
+        '/auth/validate/batch': ValidateTokenBatchApi,
         '/auth/login': AuthenticationApi,
+        '/auth/hashing/stats': PasswordHashingStatsApi,
         '/configurations': ConfigurationListApi,
 
         # Must be public, because it doesn't require authentication
         '/public/configurations/<name>': UserInterfaceConfigurationDetailApi,
         '/password/reset': ResetPasswordApi,
         '/permissions': PermissionListApi,
+        '/permissions/mask': PermissionMaskApi,
         '/notifications': NotificationListApi,
         '/notifications/summary': NotificationSummaryApi,
+        '/notifications/bulk': NotificationBulkApi,
         '/notifications/<int:notification_id>': NotificationDetailApi,
         '/roles': RoleListApi,
         '/roles/<int:role_id>': RoleDetailApi,
+        '/roles/<int:role_id>/users': RoleUserListApi,
+        '/roles/<int:role_id>/permissions': RolePermissionListApi,
         '/users/me': ProfileApi,
         '/users': UserListApi,
         '/register': RegisterApi,
@@ -102,6 +131,8 @@ def create_app(is_main_module=False):
         app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
         app.config['RQ_REDIS_URL'] = config['servers']['redis_url']
         app.config['RQ_DASHBOARD_REDIS_URL'] = app.config['RQ_REDIS_URL']
+        if config.get('rq', {}).get('worker_class'):
+            app.config['RQ_WORKER_CLASS'] = config['rq']['worker_class']
 
         engine_config = config.get('config', {})
 
@@ -115,9 +146,17 @@ def create_app(is_main_module=False):
             app.config['SQLALCHEMY_ENGINE_OPTIONS'] = final_config
 
         app.config['THORN_CONFIG'] = config
+        app.config['UNPROTECTED_URLS'] = UrlMatcher(
+            config.get('unprotected_urls'))
 
         db.init_app(app)
         rq.init_app(app)
+        redis_store.init_app(app)
+        decision_cache.init_app(app)
+        config_snapshot.init_app(app)
+        password_hasher.init_app(app)
+        ldap_pools.init_app(app)
+        smtp_pools.init_app(app)
 
         
         migrate = Migrate(app, db)        
@@ -2,10 +2,12 @@
 import json
 import jwt
 import logging
+import re
 from functools import wraps
 
 from collections import namedtuple
 from flask import Response, g as flask_g, request, current_app
+from thorn.authorization import decode_permission_mask, get_permission_bits
 from thorn.models import User, Role, Permission
 
 CONFIG_KEY = 'THORN_CONFIG'
@@ -19,8 +21,52 @@ MSG2 = 'Could not verify your access level for that URL. ' \
        'Invalid authentication token'
 
 
+# permission_mask is None when only permission names are known
 SessionUser = namedtuple(
-    "SessionUser", "id, login, email, name, first_name, last_name, locale, permissions")
+    "SessionUser", "id, login, email, name, first_name, last_name, locale, permissions, "
+    "permission_mask", defaults=(None, ))
+
+
+class UrlMatcher:
+    """
+    Compiled version of the unprotected_urls configuration, mapping paths to
+    allowed methods (an empty list allows any method). A '*' at the end of
+    a path matches any suffix, elsewhere it matches a single path segment.
+    Exact paths are resolved by a dict lookup and wildcard paths by a
+    single combined regular expression.
+    """
+    def __init__(self, urls):
+        self._exact = {}
+        self._methods = {}
+        patterns = []
+        for path, methods in (urls or {}).items():
+            methods = frozenset(m.upper() for m in methods) \
+                if methods else None
+            if '*' in path:
+                name = 'p{}'.format(len(patterns))
+                self._methods[name] = methods
+                regex = re.escape(path.rstrip('*')).replace(
+                    r'\*', '[^/]*')
+                if path.endswith('*'):
+                    regex += '.*'
+                patterns.append('(?P<{}>{})'.format(name, regex))
+            else:
+                self._exact[path] = methods
+        self._regex = re.compile('|'.join(patterns)) if patterns else None
+
+    def matches(self, path, method):
+        # Public paths allow any method, even if also listed
+        if '/public/' in path:
+            return True
+        if path in self._exact:
+            methods = self._exact[path]
+        else:
+            found = self._regex.fullmatch(path) if self._regex else None
+            if found is None:
+                return False
+            methods = self._methods[found.lastgroup]
+        return methods is None or method in methods
+
 
 def authenticate(msg, params):
     """Sends a 403 response that enables basic auth"""
@@ -49,8 +95,12 @@ def requires_permission(*permissions):
     def real_requires_permission(f):
         @wraps(f)
         def decorated(*_args, **kwargs):
-            fullfill = len(set(permissions).intersection(
-                    set(flask_g.user.permissions))) > 0
+            mask = flask_g.user.permission_mask
+            if mask is not None:
+                fullfill = (mask & get_permission_bits(permissions)) != 0
+            else:
+                fullfill = len(set(permissions).intersection(
+                        set(flask_g.user.permissions))) > 0
             if fullfill:
                 return f(*_args, **kwargs)
             else:
@@ -79,12 +129,14 @@ def requires_auth(f):
         else:
             user_id = request.headers.get('x-user-id')
             permissions = request.headers.get('x-permissions', '')
+            mask = decode_permission_mask(
+                request.headers.get('x-permission-mask'))
             user_data = request.headers.get('x-user-data')
             if all([user_data, user_id]):
                 login, email, name, locale = user_data.split(';')
                 setattr(flask_g, 'user', 
                         SessionUser(user_id, login, email, name, locale, '', '',
-                    permissions.split(',')))
+                    permissions.split(','), mask))
                 return f(*_args, **kwargs)
             else:
                 return authenticate(MSG1, {'message': 'Invalid authentication'})
@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-}
 import json
 import logging
+import time
 import urllib
 
 import jwt
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
 from thorn.app_auth import requires_auth, requires_permission
+from thorn.authorization import encode_permission_mask, \
+    get_effective_permissions, get_user_permissions, \
+    refresh_effective_permissions
 from flask import request, current_app, Response
 from flask_restful import Resource
+from sqlalchemy import or_
+from sqlalchemy.orm import selectinload
+from thorn.cache import config_snapshot, decision_cache, openid_keys
+from thorn.hashing import PasswordHashingBusy, password_hasher
 from thorn.models import User, db, AuthenticationType
 from thorn.util import check_password, ldap_authentication, encrypt_password
 from flask_babel import force_locale, gettext, get_locale
@@ -16,25 +22,40 @@ from thorn.models import *
 
 log = logging.getLogger(__name__)
 
+LDAP_KEYS = ['LDAP_SERVER', 'LDAP_BASE_DN', 'LDAP_USER_DN']
+
 
 def _get_global_roles():
     return [r.id for r in Role.query.filter(Role.all_user==True)]
 
+def _get_signed_claims_config():
+    return current_app.config['THORN_CONFIG'].get('signed_claims', {})
+
+
 def _get_jwt_token(user):
-    return jwt.encode(
-        {
-            'id': user.id,
-            #'name': '{} {}'.format(
-            #    user.first_name or '', user.last_name or '').strip(),
-            #'email': user.email,
-            #'login': user.email,
-            #'locale': user.locale,
-            #'permissions': [p.name for r in user.roles
-            #                for p in r.permissions]
-        }, current_app.secret_key)
+    claims = {'id': user.id}
+    if _get_signed_claims_config().get('enabled'):
+        # Version must be read before permissions, so a concurrent change
+        # makes the token fall back to the database
+        version = decision_cache.version(user.id, create=True)
+        if version is not None:
+            permissions = get_user_permissions(user.id)
+            claims.update({
+                'name': '{} {}'.format(user.first_name, user.last_name),
+                'email': user.email,
+                'login': user.login,
+                'locale': user.locale,
+                'permissions': [name for _, name in permissions],
+                'pm': encode_permission_mask(p for p, _ in permissions),
+                'roles': [r.id for r in user.roles] + _get_global_roles(),
+                'pv': version,
+                'iat': int(time.time()),
+            })
+    return jwt.encode(claims, current_app.secret_key)
 
 
 def _success(user):
+    token = _get_jwt_token(user)
     # Include global roles
     user.roles.extend(Role.query.filter(Role.all_user==True))
     user_data = {
@@ -51,7 +72,7 @@ def _success(user):
                 'id': r.id, 'label': r.label} for r in user.roles]
             }
     return Response(
-            json.dumps({'status': 'OK', 'token': _get_jwt_token(user), 
+            json.dumps({'status': 'OK', 'token': token, 
                 'user': user_data}), 200,
         mimetype="application/json")
 
@@ -83,6 +104,8 @@ def _create_open_id_user(openid_user:dict):
                 encrypted_password=encrypt_password('dummy'))
     user.roles = list(Role.query.filter(Role.name=='everybody'))
     db.session.add(user)
+    db.session.flush()
+    refresh_effective_permissions([user.id])
     db.session.commit()
     return user
 
@@ -106,9 +129,7 @@ class AuthenticationApi(Resource):
         config = current_app.config['THORN_CONFIG']
         if all([login, password]):
             user = User.query.filter(User.login == login).first()
-            ldap_keys = ['LDAP_SERVER', 'LDAP_BASE_DN', 'LDAP_USER_DN']
-            query = Configuration.query.filter(Configuration.name.in_(ldap_keys))
-            ldap_config = dict( (c.name, c.value) for c in query)
+            ldap_config = config_snapshot.get_many(LDAP_KEYS)
             if user:
                 if user.enabled:
                     if user.authentication_type == AuthenticationType.INTERNAL:
@@ -151,21 +172,16 @@ class ValidateTokenApi(Resource):
 
 
         # Check if URL is unprotected
-        unprotected = config.get(
-            'unprotected_urls', {})
-        path = request.headers.get('X-Original-URI', '')
-        qs = {}
-        if '?' in path:
-            path, qs = path.split('?')
-            qs = urllib.parse.parse_qs(qs)
-
+        unprotected = current_app.config['UNPROTECTED_URLS']
+        path, _, query_string = request.headers.get(
+            'X-Original-URI', '').partition('?')
         method = request.headers.get('X-Original-Method', 'INVALID')
 
-        if method in unprotected.get(path, []) or unprotected.get(path) == [] \
-                or '/public/' in path:
-            status_code = 200
-            result = {}
-        elif request.headers.get('X-Auth-Token') == str(config.get('secret')):
+        if unprotected.matches(path, method):
+            return '', 200, {}
+
+        qs = urllib.parse.parse_qs(query_string) if query_string else {}
+        if request.headers.get('X-Auth-Token') == str(config.get('secret')):
             status_code = 200
             result = { 
                     'X-User-Id': 1,
@@ -177,12 +193,20 @@ class ValidateTokenApi(Resource):
                         'pt')
                     }
         elif 'api_token' in qs:
-            user = User.query.filter(User.api_token==qs.get('api_token')[0]).first()
-            if user is not None and user.enabled \
-                    and user.status not in [UserStatus.DELETED, 
-                        UserStatus.PENDING_APPROVAL]:
-                result = self._get_result(user)
+            api_token = qs.get('api_token')[0]
+            cache_key = decision_cache.key('api_token', api_token)
+            result = decision_cache.get(cache_key)
+            if result is None:
+                user = User.query.filter(User.api_token==api_token).first()
+                if user is not None and user.enabled \
+                        and user.status not in [UserStatus.DELETED, 
+                            UserStatus.PENDING_APPROVAL]:
+                    result = self._get_result(user)
+                    decision_cache.set(cache_key, user.id, result)
+            if result is not None:
                 status_code = 200
+            else:
+                result = {}
         else: 
             authorization = (request.headers.get('Authorization') or 
                 request.headers.get('X-Authentication'))
@@ -195,33 +219,38 @@ class ValidateTokenApi(Resource):
                 offset = 0
             if authorization is not None:
                 token = authorization[offset:]
+                thorn_auth = request.headers.get('X-THORN-ID') == 'true'
+                cache_key = decision_cache.key(
+                    'thorn' if thorn_auth else 'openid', token)
+                cached = decision_cache.get(cache_key)
                 try:
-                    # import pdb; pdb.set_trace()
-                    if request.headers.get('X-THORN-ID') == 'true': # Old thorn auth
+                    if cached is not None:
+                        result = cached
+                        status_code = 200
+                    elif thorn_auth: # Old thorn auth
                         decoded = jwt.decode(token, current_app.secret_key, 
                             algorithms=["HS256"])
-                        user = User.query.get(int(decoded.get('id')))
-                        if user.enabled and user.status == UserStatus.ENABLED:
-                            result = self._get_result(user)
+                        claims_result = self._get_claims_result(decoded)
+                        if claims_result is not None:
+                            result = claims_result
                             status_code = 200
+                        else:
+                            user = User.query.get(int(decoded.get('id')))
+                            if user.enabled and \
+                                    user.status == UserStatus.ENABLED:
+                                result = self._get_result(user)
+                                decision_cache.set(cache_key, user.id, result)
+                                status_code = 200
 
                     else: # using open id
-                        openId_keys = ['OPENID_CONFIG', 'OPENID_JWT_PUB_KEY']
-                        query = Configuration.query.filter(
-                            Configuration.name.in_(openId_keys))
-                        openId_config = dict((c.name, c.value) for c in query)
-
-                        has_open_id_config = ('OPENID_CONFIG' in openId_config and 
-                                'OPENID_JWT_PUB_KEY' in openId_config)
-                        if has_open_id_config:
-                            json_conf = json.loads(openId_config['OPENID_CONFIG'])
-                            if json_conf['enabled']:
-                                cert = openId_config['OPENID_JWT_PUB_KEY'].encode(
-                                    'utf8')
-                                pkey = serialization.load_pem_public_key(cert, 
-                                    backend=default_backend())
+                        openid = openid_keys.load()
+                        if openid.config and openid.config.get('enabled'):
+                            pkey = openid.get_key(token)
+                            if pkey is None:
+                                log.warn(gettext('No OpenID key for token.'))
+                            else:
                                 decoded = jwt.decode(token.encode('utf8'), pkey, 
-                                    audience=json_conf.get('client_id'),
+                                    audience=openid.config.get('client_id'),
                                     algorithms=["RS256"])
                                 user = User.query.filter(User.login==decoded.get(
                                     'sub')).first()
@@ -233,19 +262,61 @@ class ValidateTokenApi(Resource):
                                     user = _create_open_id_user(decoded)
                                     result = self._get_result(user)
                                     status_code = 200
+                                if status_code == 200:
+                                    # Never cache beyond token expiration
+                                    ttl = None
+                                    if decoded.get('exp'):
+                                        ttl = int(decoded['exp'] - time.time())
+                                    decision_cache.set(
+                                        cache_key, user.id, result, ttl)
 
+                except PasswordHashingBusy:
+                    # Creating an OpenID user hashes a password
+                    raise
                 except Exception as ex:
                     log.error(ex)
             else:
                 log.warn(gettext('No suitable authentication method found.'))
         return '', status_code, result
 
-    def _get_result(self, user):
-        global_roles = _get_global_roles()
+    @staticmethod
+    def _get_claims_result(decoded):
+        """
+        Uses permissions carried by a token issued in signed claims mode,
+        if they are still current. Claims older than max_age are ignored
+        because an invalidation could have been lost.
+        """
+        config = _get_signed_claims_config()
+        if not config.get('enabled') or 'pv' not in decoded \
+                or 'pm' not in decoded:
+            return None
+        if decoded.get('iat', 0) + int(config.get('max_age', 3600)) \
+                < time.time():
+            return None
+        if decision_cache.version(decoded['id']) != decoded['pv']:
+            return None
+        return {
+              'X-User-Id': decoded['id'],
+              'X-Permissions': ','.join(decoded['permissions']),
+              'X-Permission-Mask': decoded['pm'],
+              'X-Roles': ','.join(map(str, decoded['roles'])),
+              'X-Locale': decoded['locale'],
+              'X-User-Data': '{};{};{};{}'.format(
+                  decoded['login'], decoded['email'],
+                  decoded['name'], decoded['locale'])
+              }
+
+    @staticmethod
+    def _get_result(user, global_roles=None, permissions=None):
+        if global_roles is None:
+            global_roles = _get_global_roles()
+        if permissions is None:
+            permissions = get_user_permissions(user.id)
         return {
               'X-User-Id': user.id,
-              'X-Permissions': ','.join([p.name for r in user.roles 
-                  for p in r.permissions]),
+              'X-Permissions': ','.join(name for _, name in permissions),
+              'X-Permission-Mask': encode_permission_mask(
+                  p for p, _ in permissions),
               'X-Roles': ','.join(map(str, [
                   r.id for r in user.roles] + global_roles)),
               'X-Locale': user.locale,
@@ -254,5 +325,138 @@ class ValidateTokenApi(Resource):
                   user.first_name, user.last_name,
                   user.locale)
               }
-    
 
+
+class ValidateTokenBatchApi(Resource):
+    """
+    Validates many tokens at once. Intended to internal services, so it
+    requires the secret token. Users, roles and effective permissions for
+    all tokens are loaded with a single set of IN queries.
+    """
+    MAX_TOKENS = 1000
+
+    def post(self):
+        config = current_app.config['THORN_CONFIG']
+        if request.headers.get('X-Auth-Token') != str(config.get('secret')):
+            return {'status': 'ERROR',
+                    'message': gettext('Invalid authentication')}, 401
+
+        tokens = (request.json or {}).get('tokens')
+        if not isinstance(tokens, list) or not tokens:
+            return {'status': 'ERROR',
+                    'message': gettext('Missing tokens in the request')}, 400
+        if len(tokens) > self.MAX_TOKENS:
+            return {'status': 'ERROR',
+                    'message': gettext('At most %(n)s tokens are allowed.',
+                                       n=self.MAX_TOKENS)}, 400
+
+        results = [None] * len(tokens)
+        # (position, kind, cache key, identity, cache ttl)
+        pending = []
+        for i, item in enumerate(tokens):
+            if isinstance(item, str):
+                item = {'token': item}
+            elif not isinstance(item, dict):
+                # Reported as invalid, like the other items not resolved
+                continue
+            token = item.get('token')
+            kind = item.get('type', 'thorn')
+            if not token or not isinstance(token, str) \
+                    or kind not in ('thorn', 'openid', 'api_token'):
+                continue
+            cache_key = decision_cache.key(kind, token)
+            cached = decision_cache.get(cache_key)
+            if cached is not None:
+                results[i] = {'status': 'OK', 'headers': cached}
+                continue
+            ttl = None
+            try:
+                if kind == 'thorn':
+                    identity = int(jwt.decode(
+                        token, current_app.secret_key,
+                        algorithms=["HS256"]).get('id'))
+                elif kind == 'openid':
+                    decoded = self._decode_open_id(token)
+                    identity = decoded.get('sub')
+                    if decoded.get('exp'):
+                        ttl = int(decoded['exp'] - time.time())
+                else:
+                    identity = token
+            except Exception as ex:
+                log.warn(ex)
+                continue
+            if identity is not None:
+                pending.append((i, kind, cache_key, identity, ttl))
+
+        if pending:
+            self._resolve(pending, results)
+
+        invalid = {'status': 'ERROR',
+                   'message': gettext('Invalid authentication')}
+        return {'status': 'OK',
+                'data': [r or invalid for r in results]}, 200
+
+    @staticmethod
+    def _decode_open_id(token):
+        openid = openid_keys.load()
+        if openid.config and openid.config.get('enabled'):
+            pkey = openid.get_key(token)
+            if pkey is not None:
+                return jwt.decode(token.encode('utf8'), pkey,
+                                  audience=openid.config.get('client_id'),
+                                  algorithms=["RS256"])
+        return {}
+
+    @staticmethod
+    def _resolve(pending, results):
+        identities = {'thorn': set(), 'openid': set(), 'api_token': set()}
+        for _, kind, _, identity, _ in pending:
+            identities[kind].add(identity)
+
+        conditions = []
+        if identities['thorn']:
+            conditions.append(User.id.in_(identities['thorn']))
+        if identities['openid']:
+            conditions.append(User.login.in_(identities['openid']))
+        if identities['api_token']:
+            conditions.append(User.api_token.in_(identities['api_token']))
+
+        users = User.query.options(selectinload(User.roles)).filter(
+                or_(*conditions)).all()
+        permissions = get_effective_permissions([u.id for u in users])
+        by_kind = {
+            'thorn': dict((u.id, u) for u in users),
+            'openid': dict((u.login, u) for u in users),
+            'api_token': dict((u.api_token, u) for u in users),
+        }
+        global_roles = _get_global_roles()
+
+        for i, kind, cache_key, identity, ttl in pending:
+            user = by_kind[kind].get(identity)
+            if user is None or not user.enabled:
+                continue
+            if kind == 'thorn' and user.status != UserStatus.ENABLED:
+                continue
+            if kind == 'api_token' and user.status in [
+                    UserStatus.DELETED, UserStatus.PENDING_APPROVAL]:
+                continue
+            headers = ValidateTokenApi._get_result(
+                user, global_roles, permissions[user.id])
+            decision_cache.set(cache_key, user.id, headers, ttl)
+            results[i] = {'status': 'OK', 'headers': headers}
+
+
+class PasswordHashingStatsApi(Resource):
+    """ Counters of the password hashing pool """
+
+    @requires_auth
+    @requires_permission('ADMINISTRATOR')
+    def get(self):
+        return {'status': 'OK', 'data': password_hasher.stats()}
+
+
+def handle_password_hashing_busy(ex):
+    """ Error handler: the password hashing pool is full (see hashing.py) """
+    return ({'status': 'ERROR',
+             'message': gettext('Server is busy. Try again later.')}, 503,
+            {'Retry-After': '1'})
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Maintains user_effective_permission, the permissions each user receives
+from their enabled roles. Permission checks read it with a single indexed
+query, instead of walking user.roles -> role.permissions.
+
+The table must be refreshed, in the same transaction, whenever user_role,
+role_permission or role.enabled change. Roles with all_user set are not
+included, because they are granted to every user (see _get_global_roles
+in auth_api).
+
+Permissions can also be carried as a bitmask, where bit n is set if the
+user has the n-th permission (ordered by id), encoded in hexadecimal.
+Checking a permission is then a single bitwise AND.
+"""
+import hashlib
+import logging
+
+from sqlalchemy import and_, select
+from thorn.cache import TTLCache
+from thorn.models import (db, Permission, Role, role_permission,
+                          user_effective_permission, user_role)
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+def _get_effective_select():
+    role = Role.__table__
+    roles = user_role.join(
+        role, and_(role.c.id == user_role.c.role_id, role.c.enabled)).join(
+            role_permission, role_permission.c.role_id == role.c.id)
+    return select(user_role.c.user_id,
+                  role_permission.c.permission_id).select_from(
+                      roles).distinct()
+
+
+def get_role_members(role_ids):
+    """ Ids of the users in the roles. Must be read before changing them. """
+    if not role_ids:
+        return set()
+    return set(v for (v, ) in db.session.query(user_role.c.user_id).filter(
+        user_role.c.role_id.in_(list(role_ids))).distinct())
+
+
+def refresh_effective_permissions(user_ids=None):
+    """
+    Recomputes the effective permissions of the users (all users, if
+    user_ids is None). Pending ORM changes are flushed first.
+    """
+    db.session.flush()
+    table = user_effective_permission
+    effective = _get_effective_select()
+    if user_ids is None:
+        db.session.execute(table.delete())
+        db.session.execute(table.insert().from_select(
+            ['user_id', 'permission_id'], effective))
+        return
+    user_ids = list(user_ids)
+    for i in range(0, len(user_ids), BATCH_SIZE):
+        batch = user_ids[i:i + BATCH_SIZE]
+        db.session.execute(table.delete().where(table.c.user_id.in_(batch)))
+        db.session.execute(table.insert().from_select(
+            ['user_id', 'permission_id'],
+            effective.where(user_role.c.user_id.in_(batch))))
+
+
+def refresh_role_members(role_ids, user_ids=()):
+    """
+    Refreshes the current members of the roles and the users in user_ids
+    (for instance, the ones removed from the roles).
+    """
+    users = get_role_members(role_ids) | set(user_ids)
+    if users:
+        refresh_effective_permissions(users)
+
+
+def get_effective_permissions(user_ids):
+    """ Returns a dict with the permissions (id, name) for each user id """
+    table = user_effective_permission
+    result = dict((user_id, []) for user_id in user_ids)
+    user_ids = list(user_ids)
+    for i in range(0, len(user_ids), BATCH_SIZE):
+        rows = db.session.query(
+            table.c.user_id, Permission.id, Permission.name).join(
+                Permission, Permission.id == table.c.permission_id).filter(
+                    table.c.user_id.in_(user_ids[i:i + BATCH_SIZE])).order_by(
+                        table.c.user_id, Permission.id)
+        for user_id, permission_id, name in rows:
+            result[user_id].append((permission_id, name))
+    return result
+
+
+def get_user_permissions(user_id):
+    return get_effective_permissions([user_id])[user_id]
+
+
+# Permissions are only created by migrations, names and ids rarely change
+_permission_index = TTLCache(max_size=1, ttl=300)
+
+
+def get_permission_index(reload=False):
+    """
+    Maps permissions to bits. Ids are sparse (e.g. ADMINISTRATOR is 1000),
+    so bits are their positions in the ordered list of ids, keeping masks
+    short. The version identifies the list: masks built with another one
+    are not decoded, because positions may have changed.
+    """
+    index = None if reload else _permission_index.get('all')
+    if index is None:
+        rows = db.session.query(Permission.id, Permission.name).order_by(
+            Permission.id).all()
+        ids = [permission_id for permission_id, _ in rows]
+        index = {
+            'version': hashlib.sha1(
+                ','.join(map(str, ids)).encode('utf8')).hexdigest()[:4],
+            'permissions': rows,
+            'bits': dict((permission_id, bit)
+                         for bit, permission_id in enumerate(ids)),
+            'names': dict((name, bit) for bit, (_, name) in enumerate(rows)),
+        }
+        _permission_index.set('all', index)
+    return index
+
+
+def encode_permission_mask(permission_ids):
+    """ Mask as <version>:<bits in hexadecimal> """
+    permission_ids = list(permission_ids)
+    index = get_permission_index()
+    if any(p not in index['bits'] for p in permission_ids):
+        index = get_permission_index(reload=True)
+    mask = 0
+    for permission_id in permission_ids:
+        mask |= 1 << index['bits'][permission_id]
+    return '{}:{:x}'.format(index['version'], mask)
+
+
+def decode_permission_mask(value):
+    """ Returns None if value is missing, invalid or of another version """
+    if not value or ':' not in value:
+        return None
+    version, bits = value.split(':', 1)
+    if version != get_permission_index()['version']:
+        return None
+    try:
+        return int(bits, 16) if bits else 0
+    except ValueError:
+        return None
+
+
+def get_permission_bits(names):
+    """ Mask with the bits of the named permissions """
+    bits = get_permission_index()['names']
+    mask = 0
+    for name in names:
+        if name in bits:
+            mask |= 1 << bits[name]
+    return mask
@@ -0,0 +1,561 @@
+# -*- coding: utf-8 -*-}
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+import redis
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from jwt.algorithms import RSAAlgorithm
+
+from thorn.models import Configuration
+
+log = logging.getLogger(__name__)
+
+CONFIG_KEY = 'THORN_CONFIG'
+
+
+class TTLCache:
+    """ Bounded, thread-safe LRU cache whose entries expire after a TTL """
+
+    def __init__(self, max_size=10000, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete_if(self, predicate):
+        with self._lock:
+            keys = [k for k, (_, v) in self._data.items() if predicate(v)]
+            for k in keys:
+                del self._data[k]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisStore:
+    """
+    Redis client shared by the caches of a process. It is created lazily,
+    after gunicorn forks its workers, and is skipped for a while after a
+    failure, so an unavailable Redis only disables the shared cache tier.
+    """
+
+    def __init__(self):
+        self.url = None
+        self.retry_interval = 30
+        self._client = None
+        self._pid = None
+        self._down_until = 0
+        self._handlers = {}
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.url = app.config.get('RQ_REDIS_URL')
+
+    @property
+    def client(self):
+        if self.url is None or self._down_until > time.monotonic():
+            return None
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    self._client = redis.Redis.from_url(
+                        self.url, socket_timeout=0.5,
+                        socket_connect_timeout=0.5)
+                    self._pid = os.getpid()
+                    self._listener = None
+        if self._handlers and self._listener is None:
+            self._start_listener()
+            if self._down_until > time.monotonic():
+                return None
+        return self._client
+
+    def listen(self):
+        """ Starts the listener of subscribed channels, if not running """
+        if self._listener is None or self._pid != os.getpid():
+            return self.client is not None
+        return True
+
+    def failed(self, ex):
+        if self._down_until < time.monotonic():
+            log.warning('Redis unavailable, shared cache disabled for %ss: %s',
+                        self.retry_interval, ex)
+        self._down_until = time.monotonic() + self.retry_interval
+        self._listener = None
+
+    def publish(self, channel, message):
+        client = self.client
+        if client is not None:
+            try:
+                client.publish(channel, message)
+            except redis.RedisError as ex:
+                self.failed(ex)
+
+    def subscribe(self, channel, handler):
+        """
+        Registers a handler for messages published in a channel. Handler
+        is also called with None when the subscription is (re)started,
+        meaning that messages may have been missed.
+        """
+        self._handlers[channel] = handler
+        self._listener = None
+
+    def _start_listener(self):
+        with self._lock:
+            if self._listener is not None:
+                return
+            try:
+                pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{
+                    channel: self._dispatch(handler)
+                    for channel, handler in self._handlers.items()})
+                self._listener = pubsub.run_in_thread(
+                    sleep_time=1, daemon=True,
+                    exception_handler=self._listener_failed)
+            except redis.RedisError as ex:
+                self.failed(ex)
+                return
+        for handler in self._handlers.values():
+            handler(None)
+
+    def _listener_failed(self, ex, pubsub, thread):
+        thread.stop()
+        pubsub.close()
+        self.failed(ex)
+
+    @staticmethod
+    def _dispatch(handler):
+        def on_message(message):
+            handler(message['data'].decode('utf8'))
+        return on_message
+
+
+redis_store = RedisStore()
+
+
+class AuthDecisionCache:
+    """
+    Caches the headers computed by ValidateTokenApi for a token, so a hit
+    does not touch the database. Entries are keyed by a hash of the token
+    (raw tokens are never kept) and must be invalidated whenever a user,
+    role or permission changes.
+
+    There are two tiers: a small per-process LRU and a Redis tier shared
+    by all workers and replicas. Redis entries carry the generation they
+    were computed in; invalidating everything just increments the
+    generation. Invalidations are also published, so other processes
+    drop their local entries.
+
+    Invalidating a user records the value of a global sequence. A decision
+    is not stored in Redis if its user was invalidated after the lookup
+    that missed, because it may have been computed from old data.
+    """
+    PREFIX = 'thorn:auth:'
+    GENERATION_KEY = PREFIX + 'generation'
+    SEQUENCE_KEY = PREFIX + 'sequence'
+    INDEX_KEY = PREFIX + 'index'
+    CHANNEL = PREFIX + 'invalidate'
+
+    def __init__(self):
+        self.enabled = False
+        self.shared = False
+        self.shared_ttl = 300
+        self.shared_size = 100000
+        self._entries = TTLCache()
+        # Generation and sequence seen when a lookup missed, so an
+        # invalidation that happens while the decision is computed is not
+        # lost
+        self._missed = threading.local()
+
+    def init_app(self, app):
+        config = app.config.get(CONFIG_KEY, {}).get(
+            'cache', {}).get('auth', {})
+        self.enabled = config.get('enabled', True)
+        self._entries = TTLCache(max_size=int(config.get('size', 10000)),
+                                 ttl=int(config.get('ttl', 30)))
+        self.shared = self.enabled and config.get('shared', True)
+        self.shared_ttl = int(config.get('shared_ttl', 300))
+        self.shared_size = int(config.get('shared_size', 100000))
+        if self.shared:
+            redis_store.subscribe(self.CHANNEL, self._on_invalidate)
+
+    @staticmethod
+    def _version_key(user_id):
+        return AuthDecisionCache.PREFIX + 'user:{}:version'.format(user_id)
+
+    @staticmethod
+    def _invalidated_key(user_id):
+        return AuthDecisionCache.PREFIX + 'user:{}:invalidated'.format(
+            user_id)
+
+    @staticmethod
+    def _token_key(key):
+        return AuthDecisionCache.PREFIX + 'token:' + key
+
+    @staticmethod
+    def _user_key(user_id):
+        return AuthDecisionCache.PREFIX + 'user:{}'.format(user_id)
+
+    @staticmethod
+    def key(kind, token):
+        return hashlib.sha256(
+            '{}:{}'.format(kind, token).encode('utf8')).hexdigest()
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is None and self.shared:
+            entry = self._get_shared(key)
+            if entry is not None:
+                self._entries.set(key, entry)
+        if entry is not None:
+            # Callers (Flask) may change the headers dict
+            return dict(entry[1])
+        return None
+
+    def set(self, key, user_id, headers, ttl=None):
+        if self.enabled:
+            if self.shared and not self._set_shared(
+                    key, user_id, headers, ttl):
+                return
+            self._entries.set(key, (user_id, dict(headers)), ttl)
+
+    def version(self, user_id, create=False):
+        """
+        Version of the permissions of a user, changed by any invalidation
+        that affects the user. Returns None if it cannot be checked: it is
+        only kept in the shared tier, so all processes see the same one.
+        Missing keys (never set, evicted or flushed) are only created if
+        create is True, when issuing a token.
+        """
+        client = redis_store.client if self.shared else None
+        if client is None:
+            return None
+        keys = [self.GENERATION_KEY, self._version_key(user_id)]
+        try:
+            values = client.mget(*keys)
+            if None in values:
+                if not create:
+                    return None
+                values = self._create_versions(client, keys)
+        except redis.RedisError as ex:
+            redis_store.failed(ex)
+            return None
+        return '{}.{}'.format(*(int(v) for v in values))
+
+    @staticmethod
+    def _create_versions(client, keys):
+        """
+        Versions start from the current time, so a key created again (e.g.
+        after a flush) never matches versions in older tokens.
+        """
+        seed = time.time_ns()
+        pipe = client.pipeline(transaction=False)
+        for key in keys:
+            pipe.set(key, seed, nx=True)
+        pipe.mget(*keys)
+        return pipe.execute()[-1]
+
+    def invalidate_user(self, user_id):
+        user_id = int(user_id)
+        removed = self._entries.delete_if(lambda v: v[0] == user_id)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Auth cache: %s entries removed for user %s',
+                      removed, user_id)
+        client = redis_store.client if self.shared else None
+        if client is not None:
+            user_key = self._user_key(user_id)
+            try:
+                # Before removing entries, so later writes are rejected
+                client.set(self._invalidated_key(user_id),
+                           client.incr(self.SEQUENCE_KEY),
+                           ex=self.shared_ttl)
+                tokens = [self._token_key(k.decode('utf8'))
+                          for k in client.smembers(user_key)]
+                pipe = client.pipeline(transaction=False)
+                pipe.delete(user_key, *tokens)
+                pipe.set(self._version_key(user_id), time.time_ns(), nx=True)
+                pipe.incr(self._version_key(user_id))
+                pipe.publish(self.CHANNEL, 'user:{}'.format(user_id))
+                pipe.execute()
+            except redis.RedisError as ex:
+                redis_store.failed(ex)
+
+    def invalidate_all(self):
+        self._entries.clear()
+        client = redis_store.client if self.shared else None
+        if client is not None:
+            try:
+                pipe = client.pipeline(transaction=False)
+                pipe.set(self.GENERATION_KEY, time.time_ns(), nx=True)
+                pipe.incr(self.GENERATION_KEY)
+                pipe.publish(self.CHANNEL, 'all')
+                pipe.execute()
+            except redis.RedisError as ex:
+                redis_store.failed(ex)
+
+    def _on_invalidate(self, message):
+        if message is not None and message.startswith('user:'):
+            user_id = int(message[5:])
+            self._entries.delete_if(lambda v: v[0] == user_id)
+        else:
+            self._entries.clear()
+
+    def _get_shared(self, key):
+        client = redis_store.client
+        if client is None:
+            return None
+        try:
+            generation, sequence, value = client.mget(
+                self.GENERATION_KEY, self.SEQUENCE_KEY, self._token_key(key))
+        except redis.RedisError as ex:
+            redis_store.failed(ex)
+            return None
+        generation = int(generation or 0)
+        if value is not None:
+            value = json.loads(value)
+            if value['g'] == generation:
+                return value['u'], value['h']
+        self._missed.key = key
+        self._missed.generation = generation
+        self._missed.sequence = int(sequence or 0)
+        return None
+
+    def _set_shared(self, key, user_id, headers, ttl):
+        """
+        Returns False if the decision is outdated (the user was invalidated
+        after the lookup missed) and must not be cached at all.
+        """
+        client = redis_store.client
+        if client is None:
+            return True
+        ttl = self.shared_ttl if ttl is None else min(ttl, self.shared_ttl)
+        if ttl <= 0:
+            return True
+        token_key = self._token_key(key)
+        user_key = self._user_key(user_id)
+        invalidated_key = self._invalidated_key(user_id)
+        try:
+            if getattr(self._missed, 'key', None) == key:
+                generation = self._missed.generation
+                sequence = self._missed.sequence
+            else:
+                generation, sequence = (int(v or 0) for v in client.mget(
+                    self.GENERATION_KEY, self.SEQUENCE_KEY))
+            with client.pipeline() as pipe:
+                # Fails if the user is invalidated before the entry is set
+                pipe.watch(invalidated_key)
+                if int(pipe.get(invalidated_key) or 0) > sequence:
+                    log.debug('Auth cache: user %s changed, not stored',
+                              user_id)
+                    return False
+                pipe.multi()
+                pipe.set(token_key, json.dumps(
+                    {'g': generation, 'u': user_id, 'h': headers}), ex=ttl)
+                pipe.sadd(user_key, key)
+                pipe.expire(user_key, self.shared_ttl)
+                # Index by expiration, used to bound the number of entries
+                now = time.time()
+                pipe.zadd(self.INDEX_KEY, {key: now + ttl})
+                pipe.zremrangebyscore(self.INDEX_KEY, '-inf', now)
+                pipe.zcard(self.INDEX_KEY)
+                excess = pipe.execute()[-1] - self.shared_size
+            if excess > 0:
+                evicted = client.zpopmin(self.INDEX_KEY, excess)
+                client.delete(*[self._token_key(k.decode('utf8'))
+                                for k, _ in evicted])
+        except redis.WatchError:
+            log.debug('Auth cache: user %s changed, not stored', user_id)
+            return False
+        except redis.RedisError as ex:
+            redis_store.failed(ex)
+        return True
+
+
+decision_cache = AuthDecisionCache()
+
+
+class ConfigurationSnapshot:
+    """
+    In-memory copy of the Configuration table, one per process. Values
+    are read with typed getters, without querying the database. The copy
+    is reloaded when configuration is changed (in every process, through
+    Redis) or, as a fallback, when it is older than refresh_interval.
+    """
+    CHANNEL = 'thorn:config:invalidate'
+
+    def __init__(self):
+        self.refresh_interval = 300
+        self._values = {}
+        self._public = frozenset()
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        config = app.config.get(CONFIG_KEY, {}).get('cache', {}).get(
+            'configuration', {})
+        self.refresh_interval = int(config.get('refresh_interval', 300))
+        redis_store.subscribe(self.CHANNEL, self._on_invalidate)
+
+    def values(self):
+        """ Reloads configuration if it was changed or is too old """
+        # Processes that do not use other caches (e.g. the RQ worker) must
+        # also receive invalidations
+        redis_store.listen()
+        if self._checked + self.refresh_interval > time.monotonic():
+            return self._values
+        with self._lock:
+            if self._checked + self.refresh_interval > time.monotonic():
+                return self._values
+            rows = Configuration.query.with_entities(
+                Configuration.name, Configuration.value,
+                Configuration.internal).all()
+            self._public = frozenset(
+                name for name, _, internal in rows if internal == False)
+            self._values = dict((name, value) for name, value, _ in rows)
+            self._checked = time.monotonic()
+        return self._values
+
+    def get(self, name, default=None):
+        return self.values().get(name, default)
+
+    def get_public(self, name):
+        """ Value of a configuration that is not internal, or None """
+        values = self.values()
+        return values.get(name) if name in self._public else None
+
+    def get_int(self, name, default=None):
+        value = self.values().get(name)
+        try:
+            return int(value) if value not in (None, '') else default
+        except ValueError:
+            log.error('Invalid value for configuration %s: %s', name, value)
+            return default
+
+    def get_json(self, name, default=None):
+        value = self.values().get(name)
+        try:
+            return json.loads(value) if value else default
+        except ValueError:
+            log.error('Invalid JSON in configuration %s', name)
+            return default
+
+    def get_many(self, names):
+        """ Dict with the values of the names that are configured """
+        values = self.values()
+        return dict((name, values[name]) for name in names if name in values)
+
+    def invalidate(self, publish=True):
+        """ Forces a reload, in all processes if publish is True """
+        self._checked = 0
+        if publish:
+            redis_store.publish(self.CHANNEL, 'configuration')
+
+    def _on_invalidate(self, message):
+        self._checked = 0
+
+
+config_snapshot = ConfigurationSnapshot()
+
+
+class OpenIdKeys:
+    """
+    Decoded OpenID configuration and parsed public keys. Parsing a RSA key
+    is expensive, so it is done only when the configuration changes.
+    OPENID_JWT_PUB_KEY may hold a single PEM key, a JSON object mapping
+    key ids (kid) to PEM keys or a JWKS document, allowing key rotation.
+    """
+    CONFIG_NAMES = ['OPENID_CONFIG', 'OPENID_JWT_PUB_KEY']
+
+    def __init__(self):
+        self.config = None
+        self.keys = {}
+        self._raw = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """ Parses configuration again if it was changed """
+        values = config_snapshot.values()
+        raw = tuple(values.get(name) for name in self.CONFIG_NAMES)
+        if raw != self._raw:
+            with self._lock:
+                if raw != self._raw:
+                    self._parse(*raw)
+                    self._raw = raw
+        return self
+
+    @staticmethod
+    def invalidate(publish=True):
+        config_snapshot.invalidate(publish)
+
+    def get_key(self, token):
+        kid = jwt.get_unverified_header(token).get('kid')
+        key = self.keys.get(kid)
+        if key is None and len(self.keys) == 1:
+            # Providers may omit kid when there is a single key
+            key = next(iter(self.keys.values()))
+        return key
+
+    def _parse(self, config, public_key):
+        self.config, self.keys = None, {}
+        if config is None or public_key is None:
+            return
+        try:
+            self.config = json.loads(config)
+            public_key = public_key.strip()
+            if public_key.startswith('{'):
+                data = json.loads(public_key)
+                if 'keys' in data:
+                    self.keys = dict(
+                        (k.get('kid'), RSAAlgorithm.from_jwk(json.dumps(k)))
+                        for k in data['keys'])
+                else:
+                    self.keys = dict((kid, self._load_pem(pem))
+                                     for kid, pem in data.items())
+            else:
+                self.keys = {None: self._load_pem(public_key)}
+        except Exception as ex:
+            log.error('Invalid OpenID configuration: %s', ex)
+
+    @staticmethod
+    def _load_pem(pem):
+        return serialization.load_pem_public_key(
+            pem.encode('utf8'), backend=default_backend())
+
+
+openid_keys = OpenIdKeys()
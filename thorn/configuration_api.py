@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-}
 from thorn.app_auth import requires_auth, requires_permission
+from thorn.pagination import is_cursor_request, paginate, \
+    paginate_by_cursor
+from thorn.projection import get_load_options
+from thorn.cache import config_snapshot, decision_cache
 from thorn.util import translate_validation
-from flask import request, current_app, g as flask_globals, abort
+from flask import request, current_app, g as flask_globals, abort, \
+    Response
 from flask_restful import Resource
 from sqlalchemy import or_
 from sqlalchemy.orm import joinedload
 from sqlalchemy.sql.expression import bindparam, text
-import math
+import hashlib
 import logging
 from thorn.schema import *
 from flask_babel import gettext
@@ -15,6 +20,9 @@ from marshmallow import ValidationError
 
 log = logging.getLogger(__name__)
 
+# Settings used by /auth/validate, cached decisions depend on them
+AUTH_CONFIGURATION_PREFIXES = ('OPENID_', )
+
 # region Protected\s*
 # endregion\w*
 
@@ -67,17 +75,30 @@ class ConfigurationListApi(Resource):
                                     bindparams=[param_q])
                                 ))
         page = request.args.get('page') or '1'
-        if page is not None and page.isdigit():
+        configurations = configurations.options(
+            *get_load_options(Configuration, only, (sort, )))
+        if is_cursor_request(request.args):
+            try:
+                items, pagination = paginate_by_cursor(
+                    configurations, getattr(Configuration, sort), Configuration.id,
+                    request.args.get('asc', 'true') == 'false', request.args)
+            except ValueError:
+                return {'status': 'ERROR',
+                        'message': gettext('Invalid pagination cursor.')}, 400
+            result = {
+                'data': ConfigurationListResponseSchema(
+                    many=True, only=only).dump(items),
+                'pagination': pagination
+            }
+        elif page is not None and page.isdigit():
             page_size = int(request.args.get('size', 20))
             page = int(page)
-            pagination = configurations.paginate(page, page_size, False)
+            items, pagination = paginate(
+                configurations, page, page_size, request.args.get('count'))
             result = {
                 'data': ConfigurationListResponseSchema(
-                    many=True, only=only).dump(pagination.items),
-                'pagination': {
-                    'page': page, 'size': page_size,
-                    'total': pagination.total,
-                    'pages': int(math.ceil(1.0 * pagination.total / page_size))}
+                    many=True, only=only).dump(items),
+                'pagination': pagination
             }
         else:
             result = {
@@ -105,7 +126,13 @@ class ConfigurationListApi(Resource):
                 configurations = []
                 for config in config:
                     configurations.append(db.session.merge(config))
+                auth_changed = any(
+                    c.name.startswith(AUTH_CONFIGURATION_PREFIXES)
+                    for c in configurations)
                 db.session.commit()
+                config_snapshot.invalidate()
+                if auth_changed:
+                    decision_cache.invalidate_all()
                 return_code = 200
                 result = {
                     'status': 'OK',
@@ -129,18 +156,42 @@ class ConfigurationListApi(Resource):
         return result, return_code
 
 class UserInterfaceConfigurationDetailApi(Resource):
+    """
+    Public configuration used by the user interface, requested by every
+    page load. Responses are read from the configuration snapshot and
+    serialized once, until the value changes. Browsers revalidate them
+    with If-None-Match and receive a 304 if nothing changed.
+    """
+    # name -> (value, etag, serialized response)
+    _responses = {}
 
     def __init__(self):
         self.human_name = gettext('Configuration')
 
-    def get(self, name):
-        config = Configuration.query.filter(Configuration.name==name, 
-                Configuration.internal==False).first()
-        if config:
+    @classmethod
+    def _get_response(cls, name, value):
+        cached = cls._responses.get(name)
+        if cached is None or cached[0] != value:
             try:
-                return {'data': json.loads(config.value)}
-            except:
+                body = json.dumps({'data': json.loads(value)}).encode('utf8')
+            except (TypeError, ValueError):
+                log.error(gettext('Invalid JSON in configuration %(name)s',
+                                  name=name))
                 abort(500)
-        else:
+            cached = (value, hashlib.sha256(body).hexdigest(), body)
+            cls._responses[name] = cached
+        return cached
+
+    def get(self, name):
+        value = config_snapshot.get_public(name)
+        if value is None:
             abort(404)
- 
+        _, etag, body = self._get_response(name, value)
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        config = current_app.config['THORN_CONFIG'].get('cache', {}).get(
+            'configuration', {})
+        response.cache_control.public = True
+        response.cache_control.max_age = int(config.get('max_age', 0))
+        response.cache_control.must_revalidate = True
+        return response.make_conditional(request)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Conditional GET for resources polled by the user interface.
+
+The ETag of a resource is computed from a small version query (update
+timestamps, counts), together with the locale and the request arguments.
+If the client already has it, a 304 is returned without loading and
+serializing the resource.
+"""
+import hashlib
+import json
+
+from flask import request, Response
+from flask_babel import get_locale
+
+
+def compute_etag(version):
+    """ Returns None if version is None (e.g. resource not found) """
+    if version is None:
+        return None
+    args = sorted(request.args.items(multi=True))
+    data = json.dumps([str(get_locale()), args, list(version)], default=str)
+    return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+
+def not_modified(etag):
+    """ Response 304 if the client has the current version, else None """
+    if etag is not None and request.if_none_match.contains(etag):
+        return Response(status=304, headers=get_headers(etag))
+    return None
+
+
+def get_headers(etag):
+    if etag is None:
+        return {}
+    # Responses depend on the user and must always be revalidated
+    return {'ETag': '"{}"'.format(etag), 'Cache-Control': 'private, no-cache'}
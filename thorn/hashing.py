@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Password hashing and verification (bcrypt) in a dedicated process pool.
+
+bcrypt at cost 12 takes about 250 ms of CPU. Running it in the request
+thread lets a burst of logins block every worker, including the ones
+serving /auth/validate. The pool limits the CPU used by hashing and the
+number of pending operations: when it is full, PasswordHashingBusy is
+raised at once, instead of queueing more requests.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+log = logging.getLogger(__name__)
+
+ROUNDS = 12
+
+
+class PasswordHashingBusy(Exception):
+    pass
+
+
+def _hash(password: bytes, rounds: int):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check(password: bytes, hashed: bytes):
+    return bcrypt.checkpw(password, hashed)
+
+
+class _Operation:
+    """
+    Holds a slot of the pool until the operation really finishes, even
+    if the caller stopped waiting (timeout). If the pool breaks while the
+    caller waits, the slot is kept for a new attempt.
+    """
+    def __init__(self, hasher):
+        self.hasher = hasher
+        self.start = time.monotonic()
+        self.future = None
+        self.waiting = True
+        self.released = False
+        self._lock = threading.Lock()
+
+    def watch(self, future):
+        self.future = future
+        future.add_done_callback(self._on_done)
+
+    def _on_done(self, future):
+        with self._lock:
+            if self.waiting and not future.cancelled() and isinstance(
+                    future.exception(), BrokenProcessPool):
+                return
+            self._release()
+
+    def finish(self):
+        with self._lock:
+            self.waiting = False
+            if self.future is None or self.future.done():
+                self._release()
+
+    def _release(self):
+        if not self.released:
+            self.released = True
+            hasher = self.hasher
+            hasher._count('pending', -1)
+            hasher._count('seconds', time.monotonic() - self.start)
+            hasher._slots.release()
+
+
+class PasswordHasher:
+    """
+    If workers is 0, operations run in the calling thread (still limited
+    by max_pending). Pools are created per process, when first used.
+    """
+    def __init__(self, workers=2, max_pending=16, timeout=10):
+        self._lock = threading.Lock()
+        self._configure(workers, max_pending, timeout)
+
+    def _configure(self, workers, max_pending, timeout):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._pid = None
+        self._stats = dict.fromkeys(
+            ['completed', 'rejected', 'timeouts', 'failed', 'pending'], 0)
+        self._stats['seconds'] = 0.0
+
+    def init_app(self, app):
+        config = app.config['THORN_CONFIG'].get('password_hashing', {})
+        self._configure(int(config.get('workers', 2)),
+                        int(config.get('max_pending', 16)),
+                        float(config.get('timeout', 10)))
+
+    def _get_executor(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # spawn: children must not inherit threads and sockets
+                    self._executor = ProcessPoolExecutor(
+                        self.workers,
+                        mp_context=multiprocessing.get_context('spawn'))
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _discard_executor(self, executor):
+        """ A worker died (e.g. killed by OOM): a new pool is created """
+        with self._lock:
+            if self._executor is executor:
+                log.error('Password hashing pool is broken, restarting it')
+                self._pid = None
+        executor.shutdown(wait=False)
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._stats[name] += value
+
+    def _submit(self, function, *args):
+        for attempt in range(2):
+            executor = self._get_executor()
+            try:
+                return executor, executor.submit(function, *args)
+            except BrokenProcessPool:
+                self._discard_executor(executor)
+                if attempt:
+                    raise
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            self._count('rejected')
+            log.warning('Password hashing is busy (%s pending operations)',
+                        self.max_pending)
+            raise PasswordHashingBusy()
+        self._count('pending')
+        operation = _Operation(self)
+        try:
+            if self.workers > 0:
+                for attempt in range(2):
+                    executor, future = self._submit(function, *args)
+                    operation.watch(future)
+                    try:
+                        result = future.result(timeout=self.timeout)
+                        break
+                    except TimeoutError:
+                        future.cancel()
+                        self._count('timeouts')
+                        raise PasswordHashingBusy()
+                    except BrokenProcessPool:
+                        self._discard_executor(executor)
+                        if attempt:
+                            raise
+            else:
+                result = function(*args)
+            self._count('completed')
+            return result
+        except PasswordHashingBusy:
+            raise
+        except Exception:
+            self._count('failed')
+            raise
+        finally:
+            operation.finish()
+
+    def hash(self, password: bytes, rounds=ROUNDS):
+        return self._run(_hash, password, rounds)
+
+    def check(self, password: bytes, hashed: bytes):
+        return self._run(_check, password, hashed)
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+        result.update({'workers': self.workers,
+                       'max_pending': self.max_pending})
+        return result
+
+
+password_hasher = PasswordHasher()
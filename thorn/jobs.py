@@ -4,11 +4,12 @@ import json
 import os
 import logging.config
 import os
-import smtplib
 import yaml
 from flask import current_app
 from flask_babel import gettext as babel_gettext, force_locale
 from thorn import rq
+from thorn.cache import config_snapshot
+from thorn.smtp_pool import smtp_pools
 from thorn.models import *
 import jinja2
 logging.config.fileConfig('logging_config.ini')
@@ -43,11 +44,8 @@ def send_email(**kwargs):
         'SMTP_PASSWORD', 'SMTP_PORT'
     ]
     try:
-        query = None
         with current_app.app_context():
-            query = Configuration.query.filter(
-                Configuration.name.in_(smtp_configs))
-        configs = dict( (c.name, c.value) for c in query)
+            configs = config_snapshot.get_many(smtp_configs)
     
         smtp_user = configs.get('SMTP_USER')
         smtp_passwd = configs.get('SMTP_PASSWORD')
@@ -71,9 +69,8 @@ def send_email(**kwargs):
             kwargs['gettext'] = babel_gettext
             body = templ.render(kwargs)
         
-        server = smtplib.SMTP_SSL(smtp_server, smtp_port)
-        server.ehlo()
-        server.login(smtp_user, smtp_passwd)
+        # Sessions are reused by the following jobs
+        pool = smtp_pools.get(smtp_server, smtp_port, smtp_user, smtp_passwd)
         from email.mime.multipart import MIMEMultipart
         from email.mime.text import MIMEText
         from email.header import Header
@@ -89,7 +86,7 @@ def send_email(**kwargs):
 
         print(body)
         to_list = to
-        server.sendmail(sender, to_list, msg.as_string())
+        pool.send(sender, to_list, msg.as_string())
     
         print('*' * 50)
     except Exception:
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Pool of LDAP connections used to authenticate users.
+
+Each login binds again (simple_bind_s) with the user credentials over a
+connection reused from the pool, avoiding a TCP/TLS handshake per login.
+Connections idle for a while are checked before being reused. When the
+server is repeatedly reported as down, a circuit breaker makes logins
+fail at once, until a new attempt is allowed after reset_timeout.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+
+import ldap
+
+log = logging.getLogger(__name__)
+
+
+class LdapUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """ Opens after `threshold` consecutive failures """
+    def __init__(self, threshold=3, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                # Half open: lets one attempt through, others keep failing
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.threshold:
+                if self._opened_at is None:
+                    log.error('LDAP server is down, failing logins for %ss',
+                              self.reset_timeout)
+                self._opened_at = time.monotonic()
+
+
+class _PooledConnection:
+    def __init__(self, connection):
+        self.connection = connection
+        self.last_used = time.monotonic()
+
+
+class LdapConnectionPool:
+    """ Bounded pool of connections to a single LDAP server """
+    def __init__(self, server, max_size=10, wait_timeout=1,
+                 network_timeout=5, timeout=10, check_after=30):
+        self.server = server
+        self.max_size = max_size
+        self.wait_timeout = wait_timeout
+        self.network_timeout = network_timeout
+        self.timeout = timeout
+        self.check_after = check_after
+        self._idle = queue.LifoQueue()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        connection = ldap.initialize('ldap://' + self.server)
+        connection.set_option(ldap.OPT_NETWORK_TIMEOUT, self.network_timeout)
+        connection.set_option(ldap.OPT_TIMEOUT, self.timeout)
+        connection.set_option(ldap.OPT_REFERRALS, 0)
+        return _PooledConnection(connection)
+
+    @staticmethod
+    def _is_healthy(pooled):
+        try:
+            pooled.connection.whoami_s()
+            return True
+        except ldap.LDAPError:
+            return False
+
+    def _discard(self, pooled):
+        with self._lock:
+            self._size -= 1
+        try:
+            pooled.connection.unbind_s()
+        except Exception:
+            pass
+
+    def _create(self):
+        """ Returns a new connection or None if the pool is full """
+        with self._lock:
+            if self._size >= self.max_size:
+                return None
+            self._size += 1
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self._size -= 1
+            raise
+
+    def _wait(self, deadline):
+        try:
+            return self._idle.get(
+                timeout=max(deadline - time.monotonic(), 0.001))
+        except queue.Empty:
+            raise LdapUnavailable('No LDAP connection available')
+
+    def acquire(self):
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except queue.Empty:
+                pooled = self._create() or self._wait(deadline)
+            if time.monotonic() - pooled.last_used < self.check_after \
+                    or self._is_healthy(pooled):
+                return pooled
+            self._discard(pooled)
+
+    def release(self, pooled, reusable=True):
+        if reusable:
+            pooled.last_used = time.monotonic()
+            self._idle.put(pooled)
+        else:
+            self._discard(pooled)
+
+    def clear(self):
+        """ Discards idle connections (e.g. after the server went down) """
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+class LdapPools:
+    """ Pools and circuit breakers by server, created per process """
+    def __init__(self):
+        self.config = {}
+        self._pools = {}
+        self._breakers = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.config = app.config['THORN_CONFIG'].get('ldap_pool', {})
+
+    def get(self, server):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pools, self._breakers = {}, {}
+                self._pid = os.getpid()
+            if server not in self._pools:
+                config = self.config
+                self._pools[server] = LdapConnectionPool(
+                    server,
+                    max_size=int(config.get('max_size', 10)),
+                    wait_timeout=float(config.get('wait_timeout', 1)),
+                    network_timeout=float(config.get('network_timeout', 5)),
+                    timeout=float(config.get('timeout', 10)),
+                    check_after=float(config.get('check_after', 30)))
+                self._breakers[server] = CircuitBreaker(
+                    int(config.get('failure_threshold', 3)),
+                    float(config.get('reset_timeout', 30)))
+            return self._pools[server], self._breakers[server]
+
+
+ldap_pools = LdapPools()
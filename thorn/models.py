@@ -7,7 +7,7 @@ from sqlalchemy import event
 from sqlalchemy.dialects.mysql import LONGTEXT
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship, backref
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.schema import Index, UniqueConstraint
 from sqlalchemy_i18n import make_translatable, translation_base, Translatable
 
 make_translatable(options={'locales': ['pt', 'en'],
@@ -120,6 +120,14 @@ user_role = db.Table(
            ForeignKey('user.id'), nullable=False, index=True),
     Column('role_id', Integer,
            ForeignKey('role.id'), nullable=False, index=True))
+# Permissions granted to users by their enabled roles, maintained by
+# thorn.authorization
+user_effective_permission = db.Table(
+    'user_effective_permission',
+    Column('user_id', Integer,
+           ForeignKey('user.id'), primary_key=True),
+    Column('permission_id', Integer,
+           ForeignKey('permission.id'), primary_key=True))
 
 
 class Asset(db.Model):
@@ -205,6 +213,10 @@ class MailQueue(db.Model):
 class Notification(db.Model):
     """ Notification """
     __tablename__ = 'notification'
+    __table_args__ = (
+        Index('ix_notification_user_id_status_created',
+              'user_id', 'status', 'created'),
+    )
 
     # Fields
     id = Column(Integer, primary_key=True)
@@ -279,6 +291,10 @@ class Role(db.Model, Translatable):
                     default=False, nullable=False)
     enabled = Column(Boolean,
                      default=True, nullable=False)
+    # Also changed when permissions, members or translations change
+    updated_at = Column(DateTime,
+                        default=datetime.datetime.utcnow,
+                        onupdate=datetime.datetime.utcnow)
 
     # Associations
     permissions = relationship(
@@ -312,8 +328,8 @@ class User(db.Model):
 
     # Fields
     id = Column(Integer, primary_key=True)
-    login = Column(String(255), nullable=False)
-    email = Column(String(255), nullable=False)
+    login = Column(String(255), nullable=False, index=True)
+    email = Column(String(255), nullable=False, index=True)
     enabled = Column(Boolean,
                      default=True, nullable=False)
     status = Column(Enum(*list(UserStatus.values()),
@@ -340,7 +356,11 @@ class User(db.Model):
     confirmation_sent_at = Column(DateTime)
     unconfirmed_email = Column(String(200))
     notes = Column(String(500))
-    api_token = Column(String(200))
+    # Tokens identify a user, so they must be unique (NULL is allowed)
+    api_token = Column(String(200), index=True, unique=True)
+    # Maintained along with notification changes, in the same transaction
+    unread_notifications = Column(Integer,
+                                  default=0, nullable=False)
 
     # Associations
     roles = relationship(
@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-}
 from thorn.app_auth import requires_auth
+from thorn.pagination import is_cursor_request, paginate, \
+    paginate_by_cursor
+from thorn.projection import get_load_options
 from flask import request, current_app, g as flask_globals
 from flask_restful import Resource
-from sqlalchemy import or_
+from sqlalchemy import or_, func, literal
+from sqlalchemy.sql.expression import bindparam
 from thorn.util import translate_validation
 
 from marshmallow import ValidationError
 import datetime
-import math
 import logging
+import os
+import queue
+import threading
 import socketio
 from thorn.schema import *
 from flask_babel import gettext
@@ -21,29 +27,322 @@ log = logging.getLogger(__name__)
 
 CONFIG_KEY = 'THORN_CONFIG'
 NAMESPACE = '/stand'
-def _get_number_of_unread_notifications():
-    return Notification.query.filter(
-        Notification.user_id==flask_globals.user.id,
-        Notification.status==NotificationStatus.UNREAD).count()
-
-def _update_notification_count(config, notification):
-    url =  config['servers']['redis_url']
-    if url[-2:] == '/1':
-        url = url[:-2]
-    mgr = socketio.RedisManager(url, 'job_output')
-    mgr.emit('notifications',
-            data={
-               'unread': _get_number_of_unread_notifications(),
-               'notification': {
-                   'text': notification.text, 
-                   'created': notification.created.isoformat()[:19], 
-                   'type': str(notification.type), 
-                   'status': 'UNREAD'
+def _get_number_of_unread_notifications(user_id=None):
+    if user_id is None:
+        user_id = flask_globals.user.id
+    return db.session.query(User.unread_notifications).filter(
+        User.id==user_id).scalar() or 0
+
+def _change_unread_count(user_id, delta):
+    """ Must be called in the transaction that changed notifications """
+    if delta:
+        # The counter is not a change in the user (see _get_user_version)
+        User.query.filter(User.id==user_id).update(
+            {User.unread_notifications: User.unread_notifications + delta,
+             User.updated_at: User.updated_at},
+            synchronize_session=False)
+
+
+def _get_socketio_url(config):
+    """
+    Redis used by stand for socket.io (servers.socketio_redis_url). If not
+    set, redis_url without database 1, which Thorn uses when stand uses 0.
+    """
+    servers = config['servers']
+    url = servers.get('socketio_redis_url')
+    if not url:
+        url = servers['redis_url']
+        if url[-2:] == '/1':
+            url = url[:-2]
+    return url
+
+
+class NotificationEmitter:
+    """
+    Sends socket.io events through a single RedisManager per process.
+    Events are queued and sent by a background thread, so a slow Redis
+    does not delay requests. If too many events are pending, new ones are
+    discarded.
+    """
+    def __init__(self, max_pending=1000):
+        self.max_pending = max_pending
+        self._events = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def emit(self, config, event, data, room=None):
+        self.emit_many(config, event, [(data, room)])
+
+    def emit_many(self, config, event, items):
+        """ Queues the same event for many rooms as a single entry """
+        if self._pid != os.getpid():
+            self._start(config)
+        try:
+            self._events.put_nowait((event, items))
+        except queue.Full:
+            log.warning('Too many pending socket.io events, discarding %s',
+                        event)
+
+    def _start(self, config):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            manager = socketio.RedisManager(_get_socketio_url(config),
+                                            'job_output',
+                                            write_only=True)
+            self._events = queue.Queue(self.max_pending)
+            threading.Thread(target=self._run, args=(manager, self._events),
+                             name='notification-emitter', daemon=True).start()
+            self._pid = os.getpid()
+
+    @staticmethod
+    def _run(manager, events):
+        while True:
+            event, items = events.get()
+            for data, room in items:
+                try:
+                    manager.emit(event, data=data, room=room,
+                                 namespace=NAMESPACE)
+                except Exception:
+                    log.exception('Error emitting %s', event)
+
+
+emitter = NotificationEmitter()
+
+def _get_notification_event(notification):
+    """ Must be called before commit, while notification is loaded """
+    return {
+        'text': notification.text, 
+        'created': notification.created.isoformat()[:19], 
+        'type': str(notification.type), 
+        'status': 'UNREAD'
+    }
+
+def _update_notification_count(config, event=None):
+    """ Must be called after commit """
+    user_id = flask_globals.user.id
+    data = {'unread': _get_number_of_unread_notifications(user_id)}
+    if event is not None:
+        data['notification'] = event
+    emitter.emit(config, 'notifications', data=data, room=f'users/{user_id}')
+
+def _recompute_unread_count(user_id):
+    """ Must be called in the transaction that changed notifications """
+    unread = db.session.query(func.count(Notification.id)).filter(
+        Notification.user_id == user_id,
+        Notification.status == NotificationStatus.UNREAD).scalar_subquery()
+    User.query.filter(User.id == user_id).update(
+        {User.unread_notifications: unread,
+         User.updated_at: User.updated_at}, synchronize_session=False)
+
+def _get_notifications_selection(data):
+    """
+    Returns the criteria for the current user's notifications selected by
+    a list of ids or by a filter (status and/or created before a date).
+    """
+    criteria = [Notification.user_id == flask_globals.user.id]
+    if 'ids' in data:
+        ids = data['ids']
+        if not isinstance(ids, list) or not all(
+                isinstance(v, int) for v in ids):
+            raise ValidationError({'ids': ['Not a valid list of integers.']})
+        criteria.append(Notification.id.in_(ids))
+    elif isinstance(data.get('filter'), dict):
+        selection = data['filter']
+        status = selection.get('status')
+        if status is not None:
+            if status not in NotificationStatus.values():
+                raise ValidationError(
+                    {'status': ['Must be one of: {}.'.format(', '.join(
+                        NotificationStatus.values()))]})
+            criteria.append(Notification.status == status)
+        before = selection.get('before')
+        if before is not None:
+            try:
+                before = datetime.datetime.fromisoformat(before)
+            except (TypeError, ValueError):
+                raise ValidationError({'before': ['Not a valid datetime.']})
+            criteria.append(Notification.created < before)
+    else:
+        return None
+    return criteria
+
+class NotificationBulkApi(Resource):
+    """
+    Creates many notifications at once, either a list of notifications
+    (each one with its user_id) or a single notification sent to all
+    members of a role or to all users. Rows are inserted in batches and
+    each user receives a single socket.io event.
+    """
+    BATCH_SIZE = 1000
+
+    def __init__(self):
+        self.human_name = gettext('Notification')
+
+    @requires_auth
+    def post(self):
+        config = current_app.config[CONFIG_KEY]
+        if request.headers.get('x-auth-token') != str(config['secret']):
+            return {'status': 'ERROR'}, 401
+        if not request.json:
+            return {'status': 'ERROR',
+                    'message': gettext("Missing json in the request body")}, 400
+
+        result = {'status': 'ERROR', 'message': gettext('Insufficient data.')}
+        return_code = 400
+        try:
+            now = datetime.datetime.utcnow()
+            if 'notifications' in request.json:
+                forms = NotificationCreateRequestSchema(many=True).load(
+                    request.json['notifications'])
+                if any(form.user_id is None for form in forms):
+                    raise ValidationError(
+                        {'user_id': ['Missing data for required field.']})
+                events = self._insert_many(forms, now)
+            elif 'notification' in request.json and (
+                    request.json.get('role_id') or
+                    request.json.get('all_users')):
+                form = NotificationCreateRequestSchema().load(
+                    request.json['notification'])
+                criteria = [User.enabled]
+                role_id = request.json.get('role_id')
+                if role_id:
+                    role = Role.query.get(role_id)
+                    if role is None:
+                        return {'status': 'ERROR', 'message': gettext(
+                            '%(name)s not found (id=%(id)s).',
+                            name=gettext('Role'), id=role_id)}, 404
+                    if not role.all_user:
+                        criteria.append(User.id.in_(
+                            db.session.query(user_role.c.user_id).filter(
+                                user_role.c.role_id == role_id)))
+                events = self._insert_for_targets(form, criteria, now)
+            else:
+                return result, return_code
+
+            db.session.commit()
+            self._emit(config, events)
+            return_code = 200
+            result = {'status': 'OK', 'count': sum(
+                count for count, _, _ in events.values())}
+        except ValidationError as e:
+            result = {'status': 'ERROR',
+                      'message': gettext("Validation error"),
+                      'errors': translate_validation(e.messages)}
+        except Exception as e:
+            result = {'status': 'ERROR',
+                      'message': gettext("Internal error")}
+            return_code = 500
+            if current_app.debug:
+                result['debug_detail'] = str(e)
+            log.exception(e)
+            db.session.rollback()
+        return result, return_code
+
+    @staticmethod
+    def _get_row(form, created):
+        return {
+            'created': created,
+            'text': form.text,
+            'link': form.link,
+            'status': form.status or NotificationStatus.UNREAD,
+            'from_system': True if form.from_system is None
+                else form.from_system,
+            'type': form.type or NotificationType.INFO,
+            'user_id': form.user_id,
+        }
+
+    def _update_unread(self, unread):
+        """
+        Increments unread counters (by user id) and returns the new values,
+        read in the same batches
+        """
+        user_table = User.__table__
+        result = {}
+        user_ids = list(unread.keys())
+        for i in range(0, len(user_ids), self.BATCH_SIZE):
+            batch = user_ids[i:i + self.BATCH_SIZE]
+            params = [{'uid': k, 'delta': unread[k]}
+                      for k in batch if unread[k]]
+            if params:
+                db.session.execute(
+                    user_table.update().where(
+                        user_table.c.id == bindparam('uid')).values(
+                            unread_notifications=(
+                                user_table.c.unread_notifications +
+                                bindparam('delta')),
+                            updated_at=user_table.c.updated_at), params)
+            result.update(db.session.query(
+                User.id, User.unread_notifications).filter(
+                    User.id.in_(batch)))
+        return result
+
+    def _insert_many(self, forms, created):
+        """
+        Returns, by user, number of notifications, the last one and the
+        number of unread notifications
+        """
+        rows = [self._get_row(form, created) for form in forms]
+        table = Notification.__table__
+        for i in range(0, len(rows), self.BATCH_SIZE):
+            db.session.execute(table.insert(), rows[i:i + self.BATCH_SIZE])
+
+        events = {}
+        unread = {}
+        for row in rows:
+            count, _ = events.get(row['user_id'], (0, None))
+            events[row['user_id']] = (count + 1, row)
+            unread[row['user_id']] = unread.get(row['user_id'], 0) + (
+                1 if row['status'] == NotificationStatus.UNREAD else 0)
+
+        counts = self._update_unread(unread)
+        return dict((user_id, (count, row, counts.get(user_id, 0)))
+                    for user_id, (count, row) in events.items())
+
+    def _insert_for_targets(self, form, criteria, created):
+        """
+        Target users are selected once, then notifications and counters
+        are changed by batches of ids. Users changed meanwhile (e.g. added
+        to the role) are not notified, but counters stay consistent.
+        """
+        row = self._get_row(form, created)
+        table = Notification.__table__
+        columns = [c for c in row.keys() if c != 'user_id']
+        values = [literal(row[c], table.c[c].type).label(c) for c in columns]
+        user_ids = [user_id for (user_id, ) in
+                    db.session.query(User.id).filter(*criteria)]
+        delta = 1 if row['status'] == NotificationStatus.UNREAD else 0
+
+        events = {}
+        for i in range(0, len(user_ids), self.BATCH_SIZE):
+            batch = user_ids[i:i + self.BATCH_SIZE]
+            select = db.session.query(*values, User.id).filter(
+                User.id.in_(batch)).statement
+            db.session.execute(table.insert().from_select(
+                columns + ['user_id'], select))
+            counts = self._update_unread(
+                dict((user_id, delta) for user_id in batch))
+            events.update((user_id, (1, row, counts.get(user_id, 0)))
+                          for user_id in batch)
+        return events
+
+    @staticmethod
+    def _emit(config, events):
+        items = []
+        for user_id, (_, row, unread) in events.items():
+            items.append(({
+                'unread': unread,
+                'notification': {
+                    'text': row['text'],
+                    'created': row['created'].isoformat()[:19],
+                    'type': str(row['type']),
+                    'status': row['status']
                 }
-           },
-           room=f'users/{flask_globals.user.id}',
-           namespace=NAMESPACE)
- 
+            }, f'users/{user_id}'))
+        if items:
+            emitter.emit_many(config, 'notifications', items)
+
+
 class NotificationSummaryApi(Resource):
     @requires_auth
     def get(self):
@@ -82,17 +381,30 @@ class NotificationListApi(Resource):
                 Notification.status.ilike(q),
                 Notification.type.ilike(q),
             ))
-        if page is not None and page.isdigit():
+        notifications = notifications.options(
+            *get_load_options(Notification, only, (sort, )))
+        if is_cursor_request(request.args):
+            try:
+                items, pagination = paginate_by_cursor(
+                    notifications, getattr(Notification, sort), Notification.id,
+                    request.args.get('asc', 'true') == 'false', request.args)
+            except ValueError:
+                return {'status': 'ERROR',
+                        'message': gettext('Invalid pagination cursor.')}, 400
+            result = {
+                'data': NotificationListResponseSchema(
+                    many=True, only=only).dump(items),
+                'pagination': pagination
+            }
+        elif page is not None and page.isdigit():
             page_size = int(request.args.get('size', 20))
             page = int(page)
-            pagination = notifications.paginate(page, page_size, False)
+            items, pagination = paginate(
+                notifications, page, page_size, request.args.get('count'))
             result = {
                 'data': NotificationListResponseSchema(
-                    many=True, only=only).dump(pagination.items),
-                'pagination': {
-                    'page': page, 'size': page_size,
-                    'total': pagination.total,
-                    'pages': int(math.ceil(1.0 * pagination.total / page_size))}
+                    many=True, only=only).dump(items),
+                'pagination': pagination
             }
         else:
             result = {
@@ -126,12 +438,15 @@ class NotificationListApi(Resource):
                 notification.user_id = flask_globals.user.id
                 notification.created = datetime.datetime.utcnow()
                 db.session.add(notification)
+                if notification.status in (None, NotificationStatus.UNREAD):
+                    _change_unread_count(notification.user_id, 1)
+                db.session.flush()
                 result = response_schema.dump(notification)
+                event = _get_notification_event(notification)
+                db.session.commit()
 
-                # FIXME Thorn use a different number for Redis than stand
-                _update_notification_count(config, notification)
+                _update_notification_count(config, event)
                 return_code = 200
-                db.session.commit()
             except ValidationError as e:
                 result = {'status': 'ERROR',
                             'message': gettext("Validation error"),
@@ -149,6 +464,57 @@ class NotificationListApi(Resource):
 
         return result, return_code
 
+    @requires_auth
+    def patch(self):
+        """ Changes the status of many notifications at once """
+        return self._change_many(delete=False)
+
+    @requires_auth
+    def delete(self):
+        """ Deletes many notifications at once """
+        return self._change_many(delete=True)
+
+    def _change_many(self, delete):
+        result = {'status': 'ERROR', 'message': gettext('Insufficient data.')}
+        return_code = 400
+        data = request.get_json(silent=True) or {}
+        try:
+            criteria = _get_notifications_selection(data)
+            status = data.get('status')
+            if not delete and status not in NotificationStatus.values():
+                criteria = None
+            if criteria is None:
+                return result, return_code
+
+            user_id = flask_globals.user.id
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(gettext('Updating %s'), self.human_name)
+            query = Notification.query.filter(*criteria)
+            if delete:
+                count = query.delete(synchronize_session=False)
+            else:
+                count = query.update({Notification.status: status},
+                                     synchronize_session=False)
+            _recompute_unread_count(user_id)
+            db.session.commit()
+            if count:
+                _update_notification_count(current_app.config[CONFIG_KEY])
+            return_code = 200
+            result = {'status': 'OK', 'count': count}
+        except ValidationError as e:
+            result = {'status': 'ERROR',
+                      'message': gettext("Validation error"),
+                      'errors': translate_validation(e.messages)}
+        except Exception as e:
+            result = {'status': 'ERROR',
+                      'message': gettext("Internal error")}
+            return_code = 500
+            if current_app.debug:
+                result['debug_detail'] = str(e)
+            log.exception(e)
+            db.session.rollback()
+        return result, return_code
+
 
 class NotificationDetailApi(Resource):
     """ REST API for a single instance of class Notification """
@@ -195,14 +561,17 @@ class NotificationDetailApi(Resource):
         if notification is not None:
             try:
                 db.session.delete(notification)
-                config = current_app.config[CONFIG_KEY]
-                _update_notification_count(config, notification)
+                if notification.status == NotificationStatus.UNREAD:
+                    _change_unread_count(notification.user_id, -1)
+                event = _get_notification_event(notification)
+                db.session.commit()
+                _update_notification_count(
+                    current_app.config[CONFIG_KEY], event)
                 result = {
                     'status': 'OK',
                     'message': gettext('%(name)s deleted with success!',
                                        name=self.human_name)
                 }
-                db.session.commit()
             except Exception as e:
                 result = {'status': 'ERROR',
                           'message': gettext("Internal error")}
@@ -247,8 +616,14 @@ class NotificationDetailApi(Resource):
             try:
                 form = request_schema.load(request.json, partial=True)
                 response_schema = NotificationItemResponseSchema()
+                old_status = notification.status
                 form.id = notification_id
                 notification = db.session.merge(form)
+                unread = NotificationStatus.UNREAD
+                _change_unread_count(
+                    notification.user_id,
+                    (notification.status == unread) - (old_status == unread))
+                event = _get_notification_event(notification)
                 db.session.commit()
 
                 if notification is not None:
@@ -262,7 +637,7 @@ class NotificationDetailApi(Resource):
                         'data': [response_schema.dump(
                             notification)]
                     }
-                _update_notification_count(current_app.config[CONFIG_KEY], notification)
+                _update_notification_count(current_app.config[CONFIG_KEY], event)
             except ValidationError as e:
                 result = {'status': 'ERROR',
                             'message': gettext("Validation error"),
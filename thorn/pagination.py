@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Keyset (cursor) pagination shared by list resources.
+
+Instead of OFFSET, a page is selected by comparing the sort key (and the
+id, used to break ties) with the values of the last (or first) row of the
+previous page, encoded in an opaque cursor. Deep pages cost the same as
+the first one and there is no COUNT(*) query, as long as the database can
+use an index on the sort column. For nullable sort columns, NULLs are kept
+where the database sorts them (first in MySQL and SQLite, last in
+PostgreSQL) and matched with IS NULL, so the conditions can still use the
+index.
+
+Cursor mode is enabled when the request has an ``after`` or ``before``
+argument. An empty value starts at the beginning (``after``) or at the end
+(``before``) of the list.
+
+Page-based pagination accepts ``count=none|estimate|exact`` to control how
+the total is computed: not at all, from the database planner statistics
+(PostgreSQL and MySQL) or with COUNT(*). Explicit modes are kept for a few
+seconds in a cache keyed by the SQL statement and its parameters. Without
+the option, the exact total is computed on every request, as before.
+"""
+import base64
+import datetime
+import json
+import logging
+import math
+
+from sqlalchemy import and_, or_
+from sqlalchemy.types import Date, DateTime
+from thorn.cache import TTLCache
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 20
+COUNT_MODES = ('none', 'estimate', 'exact')
+
+count_cache = TTLCache(max_size=1000, ttl=10)
+
+# Databases where NULL comes before any value in ascending order
+_NULLS_FIRST_DIALECTS = ('mysql', 'mariadb', 'sqlite', 'mssql')
+
+
+def is_cursor_request(args):
+    return 'after' in args or 'before' in args
+
+
+def encode_cursor(value, id_value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        value = value.isoformat()
+    data = json.dumps([value, id_value], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf8')).decode('ascii')
+
+
+def decode_cursor(cursor, column):
+    """ Raises ValueError if the cursor is invalid """
+    try:
+        value, id_value = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if value is not None:
+            if isinstance(column.type, DateTime):
+                value = datetime.datetime.fromisoformat(value)
+            elif isinstance(column.type, Date):
+                value = datetime.date.fromisoformat(value)
+            elif not isinstance(value, (str, int, float)):
+                raise ValueError('Invalid cursor value')
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(id_value, int):
+        raise ValueError('Invalid cursor')
+    return value, id_value
+
+
+def _keyset_condition(column, id_column, value, id_value, reverse,
+                      nulls_after):
+    """
+    Rows after (value, id_value) in the order of the page. nulls_after
+    tells if NULLs come after the values in that order.
+    """
+    if reverse:
+        past_id = id_column < id_value
+    else:
+        past_id = id_column > id_value
+    if value is None:
+        if nulls_after:
+            return and_(column.is_(None), past_id)
+        return or_(column.isnot(None), and_(column.is_(None), past_id))
+    if reverse:
+        conditions = [column < value]
+    else:
+        conditions = [column > value]
+    conditions.append(and_(column == value, past_id))
+    if nulls_after and getattr(column.expression, 'nullable', False):
+        conditions.append(column.is_(None))
+    return or_(*conditions)
+
+
+def keyset_paginate(query, column, id_column, descending=False,
+                    size=DEFAULT_PAGE_SIZE, after=None, before=None):
+    """
+    Returns the items of the page and the pagination information, with
+    cursors for the next and previous pages (None when there is no page).
+    Any existing ordering in query is replaced by (column, id_column).
+    """
+    backwards = before is not None and after is None
+    cursor = before if backwards else after
+    # Reading backwards inverts the order, results are reversed later
+    reverse = descending != backwards
+
+    if cursor:
+        value, id_value = decode_cursor(cursor, column)
+        nulls_first = query.session.get_bind().dialect.name \
+            in _NULLS_FIRST_DIALECTS
+        query = query.filter(_keyset_condition(
+            column, id_column, value, id_value, reverse,
+            nulls_after=nulls_first == reverse))
+
+    if reverse:
+        query = query.order_by(None).order_by(
+            column.desc(), id_column.desc())
+    else:
+        query = query.order_by(None).order_by(column, id_column)
+
+    items = query.limit(size + 1).all()
+    has_more = len(items) > size
+    items = items[:size]
+    if backwards:
+        items.reverse()
+
+    def cursor_for(item):
+        return encode_cursor(getattr(item, column.key),
+                             getattr(item, id_column.key))
+
+    next_cursor = previous_cursor = None
+    if items:
+        if backwards:
+            next_cursor = cursor_for(items[-1]) if cursor else None
+            previous_cursor = cursor_for(items[0]) if has_more else None
+        else:
+            next_cursor = cursor_for(items[-1]) if has_more else None
+            previous_cursor = cursor_for(items[0]) if cursor else None
+    return items, {'size': size, 'next': next_cursor,
+                   'previous': previous_cursor}
+
+
+def paginate_by_cursor(query, column, id_column, descending, args):
+    """
+    Reads size, after and before from the request args.
+    Raises ValueError if any of them is invalid.
+    """
+    size = int(args.get('size', DEFAULT_PAGE_SIZE))
+    if size < 1:
+        raise ValueError('Invalid size')
+    return keyset_paginate(query, column, id_column, descending, size,
+                           args.get('after'), args.get('before'))
+
+
+def _get_statement(query):
+    statement = query.order_by(None).statement
+    compiled = statement.compile(dialect=query.session.get_bind().dialect)
+    if compiled.positional:
+        params = tuple(compiled.params[k] for k in compiled.positiontup)
+    else:
+        params = compiled.params
+    return str(compiled), params
+
+
+def _estimate_count(query):
+    """
+    Uses the planner estimate for the number of rows. Returns None if the
+    database does not provide one.
+    """
+    dialect = query.session.get_bind().dialect.name
+    sql, params = _get_statement(query)
+    connection = query.session.connection()
+    if dialect == 'postgresql':
+        plan = connection.exec_driver_sql(
+            'EXPLAIN (FORMAT JSON) ' + sql, params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    elif dialect == 'mysql':
+        row = connection.exec_driver_sql('EXPLAIN ' + sql,
+                                         params).mappings().first()
+        if row is not None and row.get('rows') is not None:
+            return int(row['rows'] * float(row.get('filtered') or 100) / 100)
+    return None
+
+
+def _count(query, mode):
+    if mode not in COUNT_MODES:
+        return query.order_by(None).count()
+    key = (mode, ) + _get_statement(query)
+    key = repr(key)
+    total = count_cache.get(key)
+    if total is None:
+        if mode == 'estimate':
+            try:
+                total = _estimate_count(query)
+            except Exception:
+                log.exception('Unable to estimate number of rows')
+        if total is None:
+            total = query.order_by(None).count()
+        count_cache.set(key, total)
+    return total
+
+
+def paginate(query, page, size, count=None):
+    """
+    Returns the items of the page and the pagination information.
+    The count option is one of COUNT_MODES; any other value (or None) means
+    an exact count without cache. The total is not queried when it can be
+    computed from the page itself.
+    """
+    page = max(page, 1)
+    if size < 0:
+        size = DEFAULT_PAGE_SIZE
+    items = query.limit(size + 1).offset((page - 1) * size).all()
+    has_next = len(items) > size
+    items = items[:size]
+
+    pagination = {'page': page, 'size': size}
+    if not has_next and (items or page == 1):
+        total = (page - 1) * size + len(items)
+    elif count == 'none':
+        pagination.update({'total': None, 'pages': None,
+                           'has_next': has_next})
+        return items, pagination
+    else:
+        total = _count(query, count)
+        if count == 'estimate':
+            pagination['estimated'] = True
+            # Estimates must not contradict what is known from the page
+            if has_next:
+                total = max(total, page * size + 1)
+    pagination['total'] = total
+    pagination['pages'] = int(math.ceil(1.0 * total / size)) if size else 0
+    if count == 'none':
+        pagination['has_next'] = has_next
+    return items, pagination
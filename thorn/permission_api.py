@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-}
 from thorn.app_auth import requires_auth
+from thorn.authorization import get_permission_index
+from thorn.pagination import is_cursor_request, paginate, \
+    paginate_by_cursor
+from thorn.projection import get_load_options
+from thorn.etag import compute_etag, get_headers, not_modified
 from flask import request, current_app, g as flask_globals
 from flask_restful import Resource
-from sqlalchemy import or_
+from sqlalchemy import func, or_
 from sqlalchemy.orm import joinedload
 
-import math
 import logging
 from thorn.schema import *
 from flask_babel import gettext
@@ -16,6 +20,14 @@ log = logging.getLogger(__name__)
 # endregion
 
 
+def _get_permissions_version():
+    """ Permissions and their translations are only changed by migrations """
+    translations = db.session.query(
+        func.count(PermissionTranslation.id)).scalar_subquery()
+    return db.session.query(func.count(Permission.id),
+                            func.max(Permission.id), translations).one()
+
+
 class PermissionListApi(Resource):
     """ REST API for listing class Permission """
 
@@ -24,6 +36,11 @@ class PermissionListApi(Resource):
 
     @requires_auth
     def get(self):
+        etag = compute_etag(_get_permissions_version())
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
         if request.args.get('fields'):
             only = [f.strip() for f in request.args.get('fields').split(',')]
         else:
@@ -39,17 +56,30 @@ class PermissionListApi(Resource):
         permissions = permissions.options(joinedload(
             Permission.current_translation))
         page = request.args.get('page') or '1'
-        if page is not None and page.isdigit():
+        permissions = permissions.options(
+            *get_load_options(Permission, only))
+        if is_cursor_request(request.args):
+            try:
+                items, pagination = paginate_by_cursor(
+                    permissions, Permission.id, Permission.id,
+                    False, request.args)
+            except ValueError:
+                return {'status': 'ERROR',
+                        'message': gettext('Invalid pagination cursor.')}, 400
+            result = {
+                'data': PermissionListResponseSchema(
+                    many=True, only=only).dump(items),
+                'pagination': pagination
+            }
+        elif page is not None and page.isdigit():
             page_size = int(request.args.get('size', 20))
             page = int(page)
-            pagination = permissions.paginate(page, page_size, False)
+            items, pagination = paginate(
+                permissions, page, page_size, request.args.get('count'))
             result = {
                 'data': PermissionListResponseSchema(
-                    many=True, only=only).dump(pagination.items),
-                'pagination': {
-                    'page': page, 'size': page_size,
-                    'total': pagination.total,
-                    'pages': int(math.ceil(1.0 * pagination.total / page_size))}
+                    many=True, only=only).dump(items),
+                'pagination': pagination
             }
         else:
             result = {
@@ -59,4 +89,20 @@ class PermissionListApi(Resource):
 
         if log.isEnabledFor(logging.DEBUG):
             log.debug(gettext('Listing %(name)s', name=self.human_name))
-        return result
+        return result, 200, get_headers(etag)
+
+
+class PermissionMaskApi(Resource):
+    """
+    Bits used in X-Permission-Mask, so other services can check a mask
+    without a mapping of their own. The mask is prefixed by the version.
+    """
+    @requires_auth
+    def get(self):
+        index = get_permission_index()
+        return {
+            'version': index['version'],
+            'data': [{'bit': bit, 'id': permission_id, 'name': name}
+                     for bit, (permission_id, name) in enumerate(
+                         index['permissions'])]
+        }
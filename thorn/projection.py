@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Translates the fields requested in list APIs (fields= and simple=true) into
+SQLAlchemy loader options, so only the needed columns are selected and
+only the requested relationships are loaded.
+"""
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, load_only, noload, selectinload
+
+# Fields computed from other attributes
+DERIVED_FIELDS = {
+    'full_name': ('first_name', 'last_name'),
+}
+
+
+def _get_translated_fields(model):
+    translatable = getattr(model, '__translatable__', None)
+    if not translatable or 'class' not in translatable:
+        return set(), None
+    translation_class = translatable['class']
+    return ({attr.key for attr in inspect(translation_class).column_attrs
+             if attr.key not in ('id', 'locale')}, translation_class)
+
+
+def _get_eager_options(model, name):
+    """
+    Collections are loaded with an additional SELECT ... IN query and
+    many-to-one relationships with a join. Translations of translatable
+    targets are loaded too, because serialization reads them.
+    """
+    relationship = inspect(model).relationships[name]
+    strategy = selectinload if relationship.uselist else joinedload
+    target = relationship.mapper.class_
+    if _get_translated_fields(target)[1] is None:
+        return [strategy(getattr(model, name))]
+    return [strategy(getattr(model, name)).selectinload(
+        getattr(target, attr))
+        for attr in ('current_translation', 'translations')]
+
+
+def get_load_options(model, only, extra=(), nested=(), exclude=()):
+    """
+    Returns loader options for the fields in only (which may include
+    nested fields, like roles.name). Attributes in extra are always
+    loaded (e.g. the sort column, used in pagination cursors).
+    If any field is unknown, returns no option and the query loads
+    everything, as if no field was requested.
+    When only is empty, all columns are loaded, as well as the
+    relationships in nested (serialized by default), unless excluded.
+    """
+    if not only:
+        options = []
+        for name in nested:
+            if name not in exclude:
+                options.extend(_get_eager_options(model, name))
+        return options
+    mapper = inspect(model)
+    translated, translation_class = _get_translated_fields(model)
+
+    columns = set(extra)
+    columns.update(mapper.get_property_by_column(c).key
+                   for c in mapper.primary_key)
+    relationships = set()
+    for field in only:
+        name = field.split('.')[0]
+        for attr in DERIVED_FIELDS.get(name, (name, )):
+            if attr in mapper.column_attrs:
+                columns.add(attr)
+            elif attr in mapper.relationships:
+                relationships.add(attr)
+            elif attr not in translated:
+                return []
+
+    # Columns used to load the requested relationships (foreign keys)
+    for name in relationships:
+        for column in mapper.relationships[name].local_columns:
+            columns.add(mapper.get_property_by_column(column).key)
+
+    options = [load_only(*[getattr(model, c) for c in sorted(columns)])]
+    for rel in mapper.relationships:
+        # Translations are handled by sqlalchemy_i18n, keep them as they are
+        if rel.mapper.class_ is translation_class:
+            continue
+        if rel.key in relationships:
+            options.extend(_get_eager_options(model, rel.key))
+        else:
+            options.append(noload(getattr(model, rel.key)))
+    return options
@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-}
-from thorn.app_auth import requires_auth
+from thorn.app_auth import requires_auth, requires_permission
+from thorn.pagination import is_cursor_request, paginate, \
+    paginate_by_cursor
+from thorn.projection import get_load_options
+from thorn.authorization import get_role_members, \
+    refresh_effective_permissions, refresh_role_members
+from thorn.cache import decision_cache
+from thorn.etag import compute_etag, get_headers, not_modified
 from flask import request, current_app, g as flask_globals
 from flask_restful import Resource
-from sqlalchemy import or_
+from sqlalchemy import func, or_
 from sqlalchemy.orm import joinedload
 
-import math
+import datetime
 import logging
 from thorn.schema import *
 from flask_babel import gettext
@@ -18,6 +25,104 @@ log = logging.getLogger(__name__)
 # endregion
 
 
+def _get_members(role_id):
+    return User.query.join(user_role, user_role.c.user_id == User.id).filter(
+        user_role.c.role_id == role_id)
+
+
+# Associations of a role, as (table, column, model of the column)
+ROLE_ASSOCIATIONS = {
+    'users': (user_role, 'user_id', User),
+    'permissions': (role_permission, 'permission_id', Permission),
+}
+BATCH_SIZE = 1000
+
+
+def _get_ids(items):
+    """ Accepts a list of ids or of objects with an id """
+    ids = set()
+    for item in items or []:
+        value = item.get('id') if isinstance(item, dict) else item
+        if not isinstance(value, int):
+            raise ValidationError({'id': ['Not a valid integer.']})
+        ids.add(value)
+    return ids
+
+
+def _add_to_role(association, role_id, ids, current=None):
+    """ Inserts only the missing association rows. Returns their number """
+    table, column, model = ROLE_ASSOCIATIONS[association]
+    if not ids:
+        return 0
+    existing = set()
+    id_list = list(ids)
+    for i in range(0, len(id_list), BATCH_SIZE):
+        existing.update(v for (v, ) in db.session.query(model.id).filter(
+            model.id.in_(id_list[i:i + BATCH_SIZE])))
+    if current is None:
+        current = _get_role_association(association, role_id, existing)
+    rows = [{'role_id': role_id, column: v}
+            for v in sorted(existing - current)]
+    for i in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(table.insert(), rows[i:i + BATCH_SIZE])
+    return len(rows)
+
+
+def _remove_from_role(association, role_id, ids):
+    """ Deletes association rows. Returns their number """
+    table, column, model = ROLE_ASSOCIATIONS[association]
+    id_list = list(ids)
+    removed = 0
+    for i in range(0, len(id_list), BATCH_SIZE):
+        removed += db.session.execute(table.delete().where(
+            table.c.role_id == role_id).where(
+                table.c[column].in_(id_list[i:i + BATCH_SIZE]))).rowcount
+    return removed
+
+
+def _get_role_association(association, role_id, ids=None):
+    table, column, model = ROLE_ASSOCIATIONS[association]
+    query = db.session.query(table.c[column]).filter(
+        table.c.role_id == role_id)
+    if ids is not None:
+        if not ids:
+            return set()
+        query = query.filter(table.c[column].in_(list(ids)))
+    return set(v for (v, ) in query)
+
+
+def _set_role_association(association, role_id, ids):
+    """
+    Changes the association to contain exactly ids, issuing only the
+    needed inserts and deletes, instead of replacing the collection.
+    """
+    current = _get_role_association(association, role_id)
+    _remove_from_role(association, role_id, current - ids)
+    _add_to_role(association, role_id, ids - current, current)
+
+
+def _touch_role(role_id):
+    """ Changes in associations or translations do not update the row """
+    Role.query.filter(Role.id == role_id).update(
+        {'updated_at': datetime.datetime.utcnow()},
+        synchronize_session=False)
+
+
+def _get_role_version(role_id):
+    """ Version of a role and of its number of members, None if not found """
+    users_count = db.session.query(func.count(user_role.c.user_id)).filter(
+        user_role.c.role_id == Role.id).scalar_subquery()
+    return db.session.query(Role.updated_at, users_count).filter(
+        Role.id == role_id).first()
+
+
+def _dump_role(role):
+    """ Role details include the number of members, but not the members """
+    result = RoleItemResponseSchema(exclude=('users', )).dump(role)
+    result['users_count'] = _get_members(role.id).order_by(None).count()
+    return result
+
+
 class RoleListApi(Resource):
     """ REST API for listing class Role """
 
@@ -53,18 +158,32 @@ class RoleListApi(Resource):
 
         roles= roles.options(joinedload(Role.current_translation))
         page = request.args.get('page') or '1'
-        if page is not None and page.isdigit():
+        roles = roles.options(
+            *get_load_options(Role, only, (sort, )))
+        if is_cursor_request(request.args):
+            try:
+                items, pagination = paginate_by_cursor(
+                    roles, getattr(Role, sort), Role.id,
+                    request.args.get('asc', 'true') == 'false', request.args)
+            except ValueError:
+                return {'status': 'ERROR',
+                        'message': gettext('Invalid pagination cursor.')}, 400
+            result = {
+                'data': RoleListResponseSchema(
+                    many=True, only=only, exclude=('users.roles',)).dump(
+                        items),
+                'pagination': pagination
+            }
+        elif page is not None and page.isdigit():
             page_size = int(request.args.get('size', 20))
             page = int(page)
-            pagination = roles.paginate(page, page_size, False)
+            items, pagination = paginate(
+                roles, page, page_size, request.args.get('count'))
             result = {
                 'data': RoleListResponseSchema(
                     many=True, only=only, exclude=('users.roles',)).dump(
-                        pagination.items),
-                'pagination': {
-                    'page': page, 'size': page_size,
-                    'total': pagination.total,
-                    'pages': int(math.ceil(1.0 * pagination.total / page_size))}
+                        items),
+                'pagination': pagination
             }
         else:
             result = {
@@ -96,6 +215,8 @@ class RoleListApi(Resource):
             try:
                 if 'id' in request.json: 
                     del request.json['id']
+                permission_ids = _get_ids(permissions)
+                user_ids = _get_ids(users)
                 role = request_schema.load(request.json)
                 if role.system:
                     result = {'status': 'ERROR', 
@@ -103,17 +224,17 @@ class RoleListApi(Resource):
                                 'A system role cannot be changed')}
                     return_code = 400
                 else:
-                    role.permissions = list(Permission.query.filter(
-                        Permission.id.in_([p.get('id', 0) 
-                            for p in permissions])))
-                    role.users = list(User.query.filter(
-                        User.id.in_([u.get('id', 0) for u in users])))
-
                     if log.isEnabledFor(logging.DEBUG):
                         log.debug(gettext('Adding %s'), self.human_name)
 
                     db.session.add(role)
+                    db.session.flush()
+                    _add_to_role('permissions', role.id, permission_ids,
+                                 set())
+                    _add_to_role('users', role.id, user_ids, set())
+                    refresh_role_members([role.id])
                     db.session.commit()
+                    decision_cache.invalidate_all()
                     result = response_schema.dump(role)
                     return_code = 200
             except ValidationError as e:
@@ -145,18 +266,20 @@ class RoleDetailApi(Resource):
             log.debug(gettext('Retrieving %s (id=%s)'), self.human_name,
                       role_id)
 
+        etag = compute_etag(_get_role_version(role_id))
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
         role = Role.query.options(joinedload(Role.permissions))\
-                .options(joinedload(Role.users))\
                 .options(joinedload('permissions.current_translation'))\
                 .get(role_id)
         return_code = 200
         if role is not None:
-            # remove role.users.roles in order to avoid recursion
+            # Members are listed by RoleUserListApi
             result = {
                 'status': 'OK',
-                'data': [RoleItemResponseSchema(
-                    exclude=('users.roles',)).dump(
-                    role)]
+                'data': [_dump_role(role)]
             }
         else:
             return_code = 404
@@ -167,7 +290,7 @@ class RoleDetailApi(Resource):
                     name=self.human_name, id=role_id)
             }
 
-        return result, return_code
+        return result, return_code, get_headers(etag)
 
     @requires_auth
     def delete(self, role_id):
@@ -185,8 +308,12 @@ class RoleDetailApi(Resource):
                         }
                     return_code = 400
                 else:
+                    members = get_role_members([role_id])
                     db.session.delete(role)
+                    db.session.flush()
+                    refresh_effective_permissions(members)
                     db.session.commit()
+                    decision_cache.invalidate_all()
                     result = {
                         'status': 'OK',
                         'message': gettext('%(name)s deleted with success!',
@@ -219,28 +346,35 @@ class RoleDetailApi(Resource):
         if request.json:
             request_schema = partial_schema_factory(
                 RoleCreateRequestSchema)
-            permissions = request.json.pop('permissions') \
-                    if 'permissions' in request.json else []
-            users = request.json.pop('users') \
-                    if 'users' in request.json else []
+            # Associations missing in the request are kept unchanged
+            associations = dict(
+                (name, request.json.pop(name)) for name in ROLE_ASSOCIATIONS
+                if name in request.json)
 
             tmp_role = Role.query.get(role_id)
             data = request.json
-            response_schema = RoleItemResponseSchema(exclude=('users.roles',))
             try:
+                associations = dict((name, _get_ids(items))
+                                    for name, items in associations.items())
                 # Ignore missing fields to allow partial updates
                 role = request_schema.load(data, partial=True)
                 role.id = role_id
+                # Members before the change, whose permissions may change
+                members = get_role_members([role_id]) if (
+                    associations or 'enabled' in data) else None
                 role = db.session.merge(role)
+                db.session.flush()
 
                 # Update relationships
-                role.permissions = list(Permission.query.filter(
-                        Permission.id.in_([p.get('id', 0) 
-                            for p in permissions])))
-                role.users = list(User.query.filter(
-                    User.id.in_([u.get('id', 0) for u in users])))
+                for name, ids in associations.items():
+                    _set_role_association(name, role_id, ids)
+                _touch_role(role_id)
+                if members is not None:
+                    refresh_role_members([role_id], members)
 
                 db.session.commit()
+                # Role changes may affect permissions of any user
+                decision_cache.invalidate_all()
 
                 if role is not None:
                     return_code = 200
@@ -250,8 +384,7 @@ class RoleDetailApi(Resource):
                             '%(n)s (id=%(id)s) was updated with success!',
                             n=self.human_name,
                             id=role_id),
-                        'data': [response_schema.dump(
-                            role)]
+                        'data': [_dump_role(role)]
                     }
             except ValidationError as e:
                 result = {'status': 'ERROR',
@@ -265,3 +398,129 @@ class RoleDetailApi(Resource):
                     result['debug_detail'] = str(e)
                 db.session.rollback()
         return result, return_code
+
+
+def _change_role_association(association, role_id, add):
+    """ Adds or removes ids (in the request body) to a role association """
+    if Role.query.get(role_id) is None:
+        return {
+            'status': 'ERROR',
+            'message': gettext('%(name)s not found (id=%(id)s).',
+                               name=gettext('Role'), id=role_id)
+        }, 404
+    if not request.json or 'ids' not in request.json:
+        return {'status': 'ERROR',
+                'message': gettext('Insufficient data.')}, 400
+    try:
+        ids = _get_ids(request.json['ids'])
+        if add:
+            result = {'status': 'OK',
+                      'added': _add_to_role(association, role_id, ids)}
+        else:
+            result = {'status': 'OK',
+                      'removed': _remove_from_role(association, role_id, ids)}
+        _touch_role(role_id)
+        if association == 'users':
+            refresh_effective_permissions(ids)
+        else:
+            refresh_role_members([role_id])
+        db.session.commit()
+        decision_cache.invalidate_all()
+        return result, 200
+    except ValidationError as e:
+        return {'status': 'ERROR',
+                'message': gettext("Validation error"),
+                'errors': translate_validation(e.messages)}, 400
+    except Exception as e:
+        result = {'status': 'ERROR',
+                  'message': gettext("Internal error")}
+        if current_app.debug:
+            result['debug_detail'] = str(e)
+        log.exception(e)
+        db.session.rollback()
+        return result, 500
+
+
+class RolePermissionListApi(Resource):
+    """ REST API for adding and removing permissions of a Role """
+
+    @requires_auth
+    @requires_permission('ADMINISTRATOR')
+    def post(self, role_id):
+        return _change_role_association('permissions', role_id, add=True)
+
+    @requires_auth
+    @requires_permission('ADMINISTRATOR')
+    def delete(self, role_id):
+        return _change_role_association('permissions', role_id, add=False)
+
+
+class RoleUserListApi(Resource):
+    """ REST API for listing the members of a Role """
+    FIELDS = ['id', 'first_name', 'last_name', 'email', 'login']
+
+    def __init__(self):
+        self.human_name = gettext('User')
+
+    @requires_auth
+    def get(self, role_id):
+        if not db.session.query(Role.query.filter(
+                Role.id == role_id).exists()).scalar():
+            return {
+                'status': 'ERROR',
+                'message': gettext('%(name)s not found (id=%(id)s).',
+                                   name=gettext('Role'), id=role_id)
+            }, 404
+
+        users = _get_members(role_id)
+        sort = request.args.get('sort', 'first_name')
+        if sort not in ['id', 'email', 'login']:
+            sort = 'first_name'
+        descending = request.args.get('asc', 'true') == 'false'
+        sort_option = getattr(User, sort)
+        users = users.order_by(
+            sort_option.desc() if descending else sort_option)
+
+        q = request.args.get('query')
+        if q:
+            q = '%{}%'.format(q)
+            users = users.filter(or_(
+                User.first_name.ilike(q),
+                User.last_name.ilike(q),
+                User.login.ilike(q),
+                User.email.ilike(q)),
+            )
+        users = users.options(
+            *get_load_options(User, self.FIELDS, (sort, )))
+        schema = UserListResponseSchema(many=True, only=self.FIELDS)
+
+        if is_cursor_request(request.args):
+            try:
+                items, pagination = paginate_by_cursor(
+                    users, getattr(User, sort), User.id, descending,
+                    request.args)
+            except ValueError:
+                return {'status': 'ERROR',
+                        'message': gettext('Invalid pagination cursor.')}, 400
+        else:
+            page = request.args.get('page') or '1'
+            page = int(page) if page.isdigit() else 1
+            page_size = int(request.args.get('size', 20))
+            items, pagination = paginate(
+                users, page, page_size, request.args.get('count'))
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(gettext('Listing %(name)s', name=self.human_name))
+        return {'data': schema.dump(items), 'pagination': pagination}
+
+    @requires_auth
+    @requires_permission('ADMINISTRATOR')
+    def post(self, role_id):
+        """ Adds users to the role, without changing the other members """
+        return _change_role_association('users', role_id, add=True)
+
+    @requires_auth
+    @requires_permission('ADMINISTRATOR')
+    def delete(self, role_id):
+        """ Removes users from the role """
+        return _change_role_association('users', role_id, add=False)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Pool of authenticated SMTP sessions used by the send_email job.
+
+Opening a session costs a TLS handshake, EHLO and AUTH, so sessions are
+reused to send many messages. Sessions idle for a while are checked with
+NOOP before being reused and are closed with QUIT after max_messages
+(servers often limit messages per session). If the server drops a
+session, the message is sent again using a new one.
+
+Pools are kept by process. The default RQ worker forks a new process for
+each job, so sessions are only reused by rq.worker.SimpleWorker (see
+rq.worker_class in configuration).
+"""
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class SmtpUnavailable(Exception):
+    pass
+
+
+class _PooledSession:
+    def __init__(self, session):
+        self.session = session
+        self.last_used = time.monotonic()
+        self.messages = 0
+
+
+class SmtpConnectionPool:
+    """ Bounded pool of sessions with a single SMTP server and user """
+    def __init__(self, server, port, user, password, max_size=2,
+                 wait_timeout=30, timeout=30, check_after=30,
+                 max_messages=100):
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        self.max_size = max_size
+        self.wait_timeout = wait_timeout
+        self.timeout = timeout
+        self.check_after = check_after
+        self.max_messages = max_messages
+        self._idle = queue.LifoQueue()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        session = smtplib.SMTP_SSL(self.server, self.port,
+                                   timeout=self.timeout)
+        try:
+            session.ehlo()
+            session.login(self.user, self.password)
+        except Exception:
+            session.close()
+            raise
+        return _PooledSession(session)
+
+    @staticmethod
+    def _is_healthy(pooled):
+        try:
+            return pooled.session.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _discard(self, pooled):
+        with self._lock:
+            self._size -= 1
+        try:
+            pooled.session.quit()
+        except (smtplib.SMTPException, OSError):
+            pooled.session.close()
+
+    def _create(self):
+        """ Returns a new session or None if the pool is full """
+        with self._lock:
+            if self._size >= self.max_size:
+                return None
+            self._size += 1
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self._size -= 1
+            raise
+
+    def _wait(self, deadline):
+        try:
+            return self._idle.get(
+                timeout=max(deadline - time.monotonic(), 0.001))
+        except queue.Empty:
+            raise SmtpUnavailable('No SMTP session available')
+
+    def acquire(self):
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except queue.Empty:
+                pooled = self._create() or self._wait(deadline)
+            if time.monotonic() - pooled.last_used < self.check_after \
+                    or self._is_healthy(pooled):
+                return pooled
+            self._discard(pooled)
+
+    def release(self, pooled, reusable=True):
+        if reusable and pooled.messages < self.max_messages:
+            pooled.last_used = time.monotonic()
+            self._idle.put(pooled)
+        else:
+            self._discard(pooled)
+
+    def clear(self):
+        """ Closes idle sessions (e.g. after configuration changed) """
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+    def send(self, sender, to, message):
+        """ Sends a message, using a new session if the server dropped it """
+        for attempt in range(2):
+            pooled = self.acquire()
+            reusable = True
+            try:
+                pooled.messages += 1
+                return pooled.session.sendmail(sender, to, message)
+            except smtplib.SMTPServerDisconnected:
+                reusable = False
+                if attempt:
+                    raise
+            except smtplib.SMTPResponseException as ex:
+                # 421: service is closing the session
+                reusable = ex.smtp_code != 421
+                if reusable or attempt:
+                    raise
+            except smtplib.SMTPException:
+                # Permanent errors (e.g. recipients refused), not retried.
+                # SMTPException is a subclass of OSError.
+                raise
+            except OSError:
+                reusable = False
+                if attempt:
+                    raise
+            finally:
+                self.release(pooled, reusable)
+            log.warning('SMTP session was closed by %s, reconnecting',
+                        self.server)
+
+
+class SmtpPools:
+    """ Pools by server and credentials, created per process """
+    def __init__(self):
+        self.config = {}
+        self._pools = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.config = app.config['THORN_CONFIG'].get('smtp_pool', {})
+
+    def get(self, server, port, user, password):
+        key = (server, port, user, password)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pools = {}
+                self._pid = os.getpid()
+            if key not in self._pools:
+                # SMTP configuration changed, old sessions are not used
+                for pool in self._pools.values():
+                    pool.clear()
+                config = self.config
+                self._pools = {key: SmtpConnectionPool(
+                    server, port, user, password,
+                    max_size=int(config.get('max_size', 2)),
+                    wait_timeout=float(config.get('wait_timeout', 30)),
+                    timeout=float(config.get('timeout', 30)),
+                    check_after=float(config.get('check_after', 30)),
+                    max_messages=int(config.get('max_messages', 100)))}
+            return self._pools[key]
+
+
+smtp_pools = SmtpPools()
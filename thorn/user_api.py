@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-}
 from thorn.app_auth import requires_auth, requires_permission
+from thorn.pagination import is_cursor_request, paginate, \
+    paginate_by_cursor
+from thorn.projection import get_load_options
+from thorn.authorization import refresh_effective_permissions
+from thorn.cache import config_snapshot, decision_cache
+from thorn.etag import compute_etag, get_headers, not_modified
+from thorn.hashing import PasswordHashingBusy
 from flask import request, current_app, g as flask_globals
 from flask_restful import Resource
-from sqlalchemy import or_
+from sqlalchemy import and_, func, or_
 from thorn.util import check_password, encrypt_password, translate_validation
-import math
 import uuid
 import datetime
 import random
@@ -14,7 +20,6 @@ from thorn.schema import *
 from flask_babel import gettext, get_locale
 from thorn.jobs import send_email
 import json
-from thorn.models import Configuration
 from marshmallow import ValidationError
 
 def _get_random_string(length):
@@ -41,6 +46,8 @@ class GenerateUserTokenApi(Resource):
         user.api_token = _get_random_string(15)
         db.session.add(user)
         db.session.commit()
+        # Previous token must stop working
+        decision_cache.invalidate_user(user_id)
         return {'status': 'OK', 'token': user.api_token, 'message': 
                 gettext('A new token was generated.')}, 200
 
@@ -54,18 +61,14 @@ class ApproveUserApi(Resource):
         if not user:
             return {'status': 'ERROR', 'message': 'not found'}, 404
         user.confirmed_at = datetime.datetime.now()
-        base_url_conf = Configuration.query.filter_by(
-                name='SERVER_BASE_URL').first()
-
-        if base_url_conf is None:
-            base_url_conf = ''
+        base_url = config_snapshot.get('SERVER_BASE_URL', '')
         success_message = gettext('Registration confirmed')
         job = send_email.queue(
                 subject=success_message,
                 to=user.email, 
                 name=user.first_name + " " + user.last_name,
                 template='confirm',
-                link=base_url_conf.value,
+                link=base_url,
                 queue='thorn',)
         
         user.enabled = True
@@ -129,11 +132,8 @@ class ResetPasswordApi(Resource):
         if request.json:
             user = User.query.filter(User.email==request.json.get('email')).first()
             if user:
-                config = Configuration.query.filter(or_(
-                        Configuration.name=='SUPPORT_EMAIL', 
-                        Configuration.name=='SERVER_BASE_URL'))
-                support_email = next(c.value for c in config if c.name == 'SUPPORT_EMAIL')
-                server_url = next(c.value for c in config if c.name == 'SERVER_BASE_URL')
+                support_email = config_snapshot.get('SUPPORT_EMAIL')
+                server_url = config_snapshot.get('SERVER_BASE_URL')
 
                 user.reset_password_token = uuid.uuid4().hex
                 user.reset_password_sent_at = datetime.datetime.now() 
@@ -211,6 +211,13 @@ def _add_user(human_name, administrative=False):
                       'message': gettext("You must inform a valid password.")}
             return_code = 400
             return result, return_code
+        # Existing roles, as in _change_user. Users registering themselves
+        # cannot choose them.
+        roles = data.pop('roles', None) or []
+        if administrative:
+            roles = [Role.query.get_or_404(r.get('id')) for r in roles]
+        else:
+            roles = []
         data['encrypted_password'] = encrypt_password(
                 request.json.get('password'))
 
@@ -228,8 +235,11 @@ def _add_user(human_name, administrative=False):
                     log.debug(gettext('Adding %s'), human_name)
                 mail = {'type': 'REGISTRATION', 'user': user.login}
                 q = MailQueue(json_data=json.dumps(mail), status='PENDING')
+                user.roles = roles
                 db.session.add(user)
                 db.session.add(q)
+                db.session.flush()
+                refresh_effective_permissions([user.id])
                 db.session.commit()
                 result = {
                     'status': 'OK',
@@ -287,6 +297,8 @@ def _change_user(user_id, administrative, human_name):
             user.id = user_id
             user = db.session.merge(user)
             user.roles = roles
+            # Changing only roles would not update the row (used in ETag)
+            user.updated_at = datetime.datetime.utcnow()
             change_pass_ok = new_password is None \
                     or confirm == new_password \
                     or user.authentication_type in ['LDAP', 'OPENID']
@@ -304,7 +316,9 @@ def _change_user(user_id, administrative, human_name):
                 # user.roles = list(Role.query.filter(
                 #         Role.id.in_([r['id'] for r in roles])))
                 db.session.merge(user)
+                refresh_effective_permissions([user_id])
                 db.session.commit()
+                decision_cache.invalidate_user(user_id)
 
                 if user is not None:
                     return_code = 200
@@ -321,6 +335,10 @@ def _change_user(user_id, administrative, human_name):
                 result = {'status': 'ERROR',
                             'message': gettext("Validation error"),
                             'errors': translate_validation(e.messages)}
+        except PasswordHashingBusy:
+            # Answered with 503 by the error handler
+            db.session.rollback()
+            raise
         except Exception as e:
             result = {'status': 'ERROR',
                         'message': gettext("Internal error")}
@@ -394,19 +412,34 @@ class UserListApi(Resource):
             )
 
         page = request.args.get('page') or '1'
-        if page is not None and page.isdigit():
+        users = users.options(*get_load_options(
+            User, only, (sort, ), nested=('roles', 'workspace'),
+            exclude=exclude))
+        if is_cursor_request(request.args):
+            try:
+                items, pagination = paginate_by_cursor(
+                    users, getattr(User, sort), User.id,
+                    request.args.get('asc', 'true') == 'false', request.args)
+            except ValueError:
+                return {'status': 'ERROR',
+                        'message': gettext('Invalid pagination cursor.')}, 400
+            result = {
+                'data': UserListResponseSchema(
+                    many=True, only=only,
+                    exclude=exclude + ['roles.users']).dump(items),
+                'pagination': pagination
+            }
+        elif page is not None and page.isdigit():
             page_size = int(request.args.get('size', 20))
             page = int(page)
-            pagination = users.paginate(page, page_size, False)
+            items, pagination = paginate(
+                users, page, page_size, request.args.get('count'))
             # remove user.roles.users in order to avoid recursion
             exclude.append('roles.users')
             result = {
                 'data': UserListResponseSchema(
-                    many=True, only=only, exclude=exclude).dump(pagination.items),
-                'pagination': {
-                    'page': page, 'size': page_size,
-                    'total': pagination.total,
-                    'pages': int(math.ceil(1.0 * pagination.total / page_size))}
+                    many=True, only=only, exclude=exclude).dump(items),
+                'pagination': pagination
             }
         else:
             result = {
@@ -424,6 +457,18 @@ class RegisterApi(Resource):
     def post(self):
        return _add_user(self.human_name) 
 
+def _get_user_version(user_id):
+    """
+    Version of a user and of its roles (which are part of its details),
+    read without loading them. None if the user does not exist.
+    """
+    return db.session.query(
+        User.updated_at, func.count(Role.id), func.max(Role.updated_at)
+    ).outerjoin(user_role, user_role.c.user_id == User.id).outerjoin(
+        Role, and_(Role.id == user_role.c.role_id, Role.enabled)).filter(
+            User.id == user_id).group_by(User.id, User.updated_at).first()
+
+
 class UserDetailApi(Resource):
     """ REST API for a single instance of class User """
     def __init__(self):
@@ -436,6 +481,11 @@ class UserDetailApi(Resource):
             log.debug(gettext('Retrieving %s (id=%s)'), self.human_name,
                       user_id)
 
+        etag = compute_etag(_get_user_version(user_id))
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
         user = User.query.get(user_id)
         return_code = 200
         if user is not None:
@@ -454,7 +504,7 @@ class UserDetailApi(Resource):
                     name=self.human_name, id=user_id)
             }
 
-        return result, return_code
+        return result, return_code, get_headers(etag)
 
     @requires_auth
     @requires_permission('ADMINISTRATOR')
@@ -469,6 +519,7 @@ class UserDetailApi(Resource):
                 user.enabled = False
                 db.session.add(user)
                 db.session.commit()
+                decision_cache.invalidate_user(user_id)
                 result = {
                     'status': 'OK',
                     'message': gettext('%(name)s deleted with success!',
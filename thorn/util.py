@@ -1,18 +1,19 @@
 import logging
 
-import bcrypt
 import ldap
 from flask_babel import gettext
+from thorn.hashing import password_hasher
+from thorn.ldap_pool import LdapUnavailable, ldap_pools
 
 log = logging.getLogger(__name__)
 
 
 def encrypt_password(password: str):
-    return bcrypt.hashpw(password.encode('utf8'), bcrypt.gensalt(12))
+    return password_hasher.hash(password.encode('utf8'))
 
 
 def check_password(password: str, hashed: str):
-    check = bcrypt.checkpw(password, hashed)
+    check = password_hasher.check(password, hashed)
     return check
 
 
@@ -27,23 +28,42 @@ def ldap_authentication(ldap_config: dict, login: str, password: str):
     base_dn = ldap_config.get('LDAP_BASE_DN')
     user_dn = ldap_config.get('LDAP_USER_DN').format(login=login)
 
-    connect = ldap.initialize('ldap://' + ldap_server)
-    connect.set_option(ldap.OPT_NETWORK_TIMEOUT, 5.0)
+    pool, breaker = ldap_pools.get(ldap_server)
+    if not breaker.allow():
+        log.error(gettext('LDAP server is down.'))
+        return None
+    try:
+        pooled = pool.acquire()
+    except LdapUnavailable:
+        log.error(gettext('LDAP server is busy.'))
+        return None
+    except ldap.LDAPError:
+        breaker.failure()
+        log.error(gettext('LDAP server is down.'))
+        return None
+
+    reusable = True
     try:
-        connect.set_option(ldap.OPT_REFERRALS, 0)
+        # Connections are reused, each login binds again
+        connect = pooled.connection
         connect.simple_bind_s(user_dn, password)
         result = connect.search_s(
             base_dn, ldap.SCOPE_SUBTREE,
             'uid=' + login)
-        connect.unbind_s()
+        breaker.success()
         return result
     except ldap.INVALID_CREDENTIALS:
-        pass
+        breaker.success()
     except ldap.SERVER_DOWN:
+        reusable = False
+        breaker.failure()
+        pool.clear()
         log.error(gettext('LDAP server is down.'))
     except ldap.LDAPError as lde:
-        connect.unbind_s()
+        reusable = False
         log.error(gettext('LDAP server reported an error.'))
+    finally:
+        pool.release(pooled, reusable)
 
 
 def translate_validation(validation_errors):